@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+# Fault injection run of the interrogator against the pty FreeEMS emulator, no hardware needed. Interrogates the
+# emulator with lost responses, late responses and locations that are never answered, and checks that the contents
+# read match the emulator and that only the dead locations are reported as failed.
+#
+# Usage: python benchmarks/bench_interrogator.py [--locations N] [--window N] [--latency-ms MS] [--seed N]
+#
+
+__author__ = 'ari'
+
+import sys
+import time
+import argparse
+import serial
+from os.path import join, dirname
+
+# prepend src path before systemwide path
+sys.path.insert(0, join(dirname(__file__), '..', 'src', 'main', 'python'))
+from fuct import emulator, interrogator, client as fuct_client
+
+SCENARIOS = [
+    ('clean', {}),
+    ('drop 2%', {'drop_rate': 0.02}),
+    ('late 2%', {'late_rate': 0.02}),
+    ('1 dead', {'dead_ids': (0x0105,)}),
+    ('3 dead', {'dead_ids': (0x0102, 0x0110, 0x0111)}),
+]
+
+
+def run(name, faults, args):
+    emu = emulator.EMSEmulator(locations=args.locations, latency_ms=args.latency_ms, seed=args.seed, **faults)
+    emu.start()
+    ser = serial.Serial(emu.port, 115200, timeout=0.1)
+    client = fuct_client.Client(ser).start()
+    try:
+        i = interrogator.Interrogator(client, window=args.window)
+        time1 = time.time()
+        meta, location_ids = i.get_metadata()
+        locations = i.interrogate(location_ids)
+        elapsed = time.time() - time1
+    finally:
+        client.close()
+        ser.close()
+        emu.stop()
+
+    wrong = [lid for lid, loc in locations.iteritems()
+             if (loc.ram is not None and loc.ram != emu.ram[lid]) or
+                (loc.flash is not None and loc.flash != emu.flash[lid])]
+    expected = sorted(faults.get('dead_ids', ()))
+    ok = not wrong and i.failed == expected
+    print "%-8s %-4s %7.2f s %5d requests %4d retries %4d timeouts  failed: %s%s" % \
+          (name, 'ok' if ok else 'FAIL', elapsed, i.stats['requests'], i.stats['retries'], i.stats['timeouts'],
+           ', '.join('0x%04x' % lid for lid in i.failed) or '-',
+           ('  wrong data: %s' % ', '.join('0x%04x' % lid for lid in wrong)) if wrong else '')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Interrogator fault injection on the FreeEMS emulator')
+    parser.add_argument('--locations', type=int, default=40, help='locations on the emulator (default: 40)')
+    parser.add_argument('--window', type=int, default=interrogator.Interrogator.WINDOW,
+                        help='requests in flight (default: %d)' % interrogator.Interrogator.WINDOW)
+    parser.add_argument('--latency-ms', type=float, default=1, help='processing time of a request (default: 1)')
+    parser.add_argument('--seed', type=int, default=1, help='fault injection seed (default: 1)')
+    args = parser.parse_args()
+
+    results = [run(name, faults, args) for name, faults in SCENARIOS]
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
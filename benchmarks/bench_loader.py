@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+# Benchmark of the fuctloader commands against the pty serial monitor emulator, no hardware needed.
+# Reports wall clock time and bytes/s for every command.
+#
+# Usage: python benchmarks/bench_loader.py [--pages N] [--byte-us US] [--erase-ms MS] [--drop-rate R]
+#
+
+__author__ = 'ari'
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import serial
+from os.path import join, dirname
+
+# prepend src path before systemwide path
+sys.path.insert(0, join(dirname(__file__), '..', 'src', 'main', 'python'))
+from fuct import emulator
+from fuct.apps import loader
+from bench_srecord import generate_s19
+
+
+def run(name, func, params, size, results):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')  # Hide progress bars
+    time1 = time.time()
+    try:
+        ok = func(params)
+    except ValueError, ex:
+        ok = False
+        logging.getLogger('fuctlog').error("%s: %s" % (name, ex.message))
+    finally:
+        elapsed = time.time() - time1
+        sys.stdout.close()
+        sys.stdout = stdout
+    results.append((name, ok, size, elapsed))
+    print "%-10s %-5s %8d B %8.2f s %10.0f B/s" % (name, 'ok' if ok else 'FAIL', size, elapsed, size / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fuctloader benchmark on the serial monitor emulator')
+    parser.add_argument('--pages', type=int, default=4, help='pages in the generated firmware (default: 4)')
+    parser.add_argument('--byte-us', type=float, default=86.8, help='wire time per byte (default: 86.8, 115200 baud)')
+    parser.add_argument('--erase-ms', type=int, default=20, help='page erase time (default: 20)')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='probability of a lost response')
+    parser.add_argument('--commands', default='device,load,fastload,diffload,verify,erase,rip',
+                        help='comma separated commands to run')
+    args = parser.parse_args()
+
+    logging.getLogger('fuctlog').setLevel(logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix='fuct-bench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)  # rip and device write their output into the working directory
+
+    firmware = join(workdir, 'bench.s19')
+    generate_s19(firmware, 0x100 - args.pages, 0xFF)
+    image_size = args.pages * 16384
+    # erase and rip only touch the pages of the image as the firmware is always given
+    image_pages = loader.CmdHandler.load_firmware(firmware, False).image.pages()
+
+    emu = emulator.SMEmulator(byte_us=args.byte_us, erase_ms=args.erase_ms, drop_rate=args.drop_rate, seed=1)
+    emu.start()
+    ser = serial.Serial(emu.port, 115200, timeout=0.02)
+    options = argparse.Namespace(no_cache=True, baud=None, resume=False, tag=None, format='s19')
+    params = (ser, firmware, options)
+    handler = loader.CmdHandler
+
+    print "Emulated serial monitor on %s: %.1f us/byte, %d ms page erase, %d page firmware" % \
+          (emu.port, args.byte_us, args.erase_ms, args.pages)
+    results = []
+    sizes = {
+        'device': 2048,
+        'load': image_size,
+        'fastload': image_size,
+        'diffload': image_size,
+        'verify': image_size,
+        'erase': len(image_pages) * 16384,
+        'rip': len(image_pages) * 16384
+    }
+    for name in args.commands.split(','):
+        run(name, getattr(handler, 'do_%s' % name), params, sizes[name], results)
+
+    ser.close()
+    emu.stop()
+    os.chdir(cwd)
+    shutil.rmtree(workdir)
+    print "Emulator: %(commands)d commands, %(rx_bytes)d bytes in, %(tx_bytes)d bytes out, %(dropped)d dropped" % emu.stats
+    return 0 if all(ok for _, ok, _, _ in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
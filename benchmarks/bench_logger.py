@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+# Throughput benchmark of the fuctlogger logging loop on a pty (Linux/OS X only). A child process pushes a stream of
+# log packets into the pty as fast as the reader takes it, the old loop (128 byte reads, a stat, a write and three
+# stdout writes per read) and LogRecorder log it into a temporary directory, LogRecorder with each compression codec.
+# Reports MB/s, the CPU time of the logging process per MB (the compressor thread included) and the size on disk.
+# Every logfile is decompressed and checked against the stream size.
+#
+# Usage: python benchmarks/bench_logger.py [--size MB]
+#
+
+__author__ = 'ari'
+
+import os
+import sys
+import tty
+import time
+import gzip
+import shutil
+import argparse
+import tempfile
+import subprocess
+import bz2
+import serial
+from os.path import join, dirname
+
+# prepend src path before systemwide path
+sys.path.insert(0, join(dirname(__file__), '..', 'src', 'main', 'python'))
+from fuct.apps import logger
+from bench_rx import generate_stream
+
+WRITER = '''
+import os, sys
+fd, size, path = int(sys.argv[1]), int(sys.argv[2]), sys.argv[3]
+data = open(path, 'rb').read()
+sent = 0
+while sent < size:
+    chunk = data[sent % len(data):][:min(4096, size - sent)]
+    sent += os.write(fd, chunk)
+'''
+
+
+def old_loop(ser, logname, size, devnull):
+    ser.timeout = 0.02
+    logfile = open(logname, 'w+')
+    spinner = logger.busy_icon()
+    total = 0
+    while total < size:
+        buf = ser.read(128)
+        if os.path.getsize(logname) >= 1 << 40:
+            pass  # Rotation never happens here, the stat does
+        logfile.write(buf)
+        total += len(buf)
+        devnull.write(spinner.next())
+        devnull.flush()
+        devnull.write('\b')
+    logfile.close()
+
+
+def recorder_loop(codec):
+    def loop(ser, logname, size, devnull):
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            recorder = logger.LogRecorder(ser, logname, 1 << 40, codec)
+            recorder.run(limit=size)
+            return recorder.close()
+        finally:
+            sys.stdout = stdout
+    return loop
+
+
+def logged_size(filepath):
+    opener = {'.bz2': bz2.BZ2File, '.gz': gzip.open}.get(os.path.splitext(filepath)[1], open)
+    if filepath.endswith('.xz'):
+        opener = logger.lzma.LZMAFile
+    size = 0
+    with opener(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            size += len(chunk)
+    return size
+
+
+def run(name, loop, size, streamfile, tmpdir, devnull):
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    ser = serial.Serial(os.ttyname(slave), 115200, timeout=logger.READ_TIMEOUT)
+    writer = subprocess.Popen([sys.executable, '-c', WRITER, str(master), str(size), streamfile],
+                              close_fds=False)
+    cpu1 = sum(os.times()[:2])
+    time1 = time.time()
+    logname = loop(ser, join(tmpdir, name + '.bin'), size, devnull) or join(tmpdir, name + '.bin')
+    elapsed = time.time() - time1
+    cpu = sum(os.times()[:2]) - cpu1
+    writer.wait()
+    ser.close()
+    os.close(master)
+    os.close(slave)
+    written = os.path.getsize(logname)
+    print "%-14s %8.2f MB/s %8.3f CPU s/MB %10d bytes" % (name, size / elapsed / 1000000, cpu / (size / 1e6), written)
+    return logged_size(logname) == size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fuctlogger logging loop throughput on a pty')
+    parser.add_argument('--size', type=float, default=20, help='stream size in MB (default: 20)')
+    args = parser.parse_args()
+
+    size = int(args.size * 1000000)
+    tmpdir = tempfile.mkdtemp()
+    devnull = open(os.devnull, 'w')
+    try:
+        streamfile = join(tmpdir, 'stream')
+        with open(streamfile, 'wb') as f:
+            f.write(generate_stream())
+        codecs = ['none', 'zlib', 'bz2'] + (['lzma'] if logger.lzma is not None else [])
+        results = [run('old', old_loop, size, streamfile, tmpdir, devnull)]
+        results.extend(run('recorder-' + codec, recorder_loop(codec), size, streamfile, tmpdir, devnull)
+                       for codec in codecs)
+    finally:
+        devnull.close()
+        shutil.rmtree(tmpdir)
+    if not all(results):
+        print "Logged size differs from the stream!"
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
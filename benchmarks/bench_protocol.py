@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+# Micro-benchmark of the packet builder. Compares Protocol.create_packet and escape_packet against building every
+# packet from scratch and escaping byte by byte (the pre-template builder), and times decode_packet.
+#
+# Usage: python benchmarks/bench_protocol.py [--rounds N]
+#
+
+__author__ = 'ari'
+
+import sys
+import time
+import struct
+import random
+import argparse
+from os.path import join, dirname
+
+# prepend src path before systemwide path
+sys.path.insert(0, join(dirname(__file__), '..', 'src', 'main', 'python'))
+from fuct.protocol import Protocol
+
+
+def escape_bytewise(data):
+    edata = bytearray()
+    for c in data:
+        if c == 0xAA:
+            edata.extend(b'\xBB\x55')
+        elif c == 0xBB:
+            edata.extend(b'\xBB\x44')
+        elif c == 0xCC:
+            edata.extend(b'\xBB\x33')
+        else:
+            edata.append(c)
+    return edata
+
+
+def create_from_scratch(payload, location=None, size=None, data=None, use_length=False):
+    beef = bytearray()
+    if location is not None:
+        beef.extend(struct.pack('>HH', location[0], location[1]))
+    if size is not None:
+        beef.extend(struct.pack('>H', size))
+    if data is not None:
+        beef.extend(data)
+    beef_size = len(beef)
+    msg = bytearray()
+    msg.append(0x01 if use_length and beef_size > 0 else 0x00)
+    msg.extend(struct.pack('>H', payload))
+    if use_length and beef_size > 0:
+        msg.extend(struct.pack('>H', beef_size))
+    if beef_size > 0:
+        msg.extend(beef)
+    msg.append(sum(msg) & 0xff)
+    msg = escape_bytewise(msg)
+    msg.insert(0, 0xAA)
+    msg.append(0xCC)
+    return msg
+
+
+def packet_shapes():
+    """
+    The packets the trigger tool and the interrogator send
+    """
+    return [
+        ((Protocol.FE_CMD_DECODER,), {}),
+        ((Protocol.FE_CMD_LOCATION_ID_INFO,), {'data': struct.pack('>H', 0xC003)}),
+        ((Protocol.FE_CMD_RAM_READ, (0xC003, 0x0000), 1024), {}),
+        ((Protocol.FE_CMD_FLASH_READ,), {'location': Protocol.FE_LOCATION_TRIGGER, 'size': 2}),
+        ((Protocol.FE_CMD_FLASH_WRITE,), {'location': Protocol.FE_LOCATION_TRIGGER, 'size': 2,
+                                          'data': struct.pack('>H', 0x1194), 'use_length': True}),
+    ]
+
+
+def timed(func, rounds):
+    time1 = time.time()
+    func(rounds)
+    elapsed = time.time() - time1
+    return elapsed, rounds / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Protocol packet builder benchmark')
+    parser.add_argument('--rounds', type=int, default=50000, help='calls per case (default: 50000)')
+    args = parser.parse_args()
+
+    shapes = packet_shapes()
+    for a, kw in shapes:
+        if Protocol.create_packet(*a, **kw) != create_from_scratch(*a, **kw):
+            print "Packets differ for %s %s" % (a, kw)
+            return 1
+
+    rnd = random.Random(6)
+    data = bytearray(rnd.getrandbits(8) for _ in xrange(256))
+    frame = Protocol.create_packet(0x191, data=data, use_length=True)[1:-1]
+    if Protocol.escape_packet(data) != escape_bytewise(data):
+        print "Escaped data differs"
+        return 1
+
+    def run_shapes(create):
+        def run(rounds):
+            for i in xrange(rounds):
+                a, kw = shapes[i % len(shapes)]
+                create(*a, **kw)
+        return run
+
+    buf = bytearray(1024)
+    tmpl = Protocol.template(Protocol.FE_CMD_FLASH_WRITE, Protocol.FE_LOCATION_TRIGGER, 2, 2, True)
+    offset = struct.pack('>H', 0x1194)
+
+    cases = [
+        ('create_packet', run_shapes(create_from_scratch), run_shapes(Protocol.create_packet)),
+        ('build_into', lambda n: [create_from_scratch(0x0102, (0xC003, 0x0060), 2, offset, True) for _ in xrange(n)],
+         lambda n: [tmpl.build_into(buf, 0, offset) for _ in xrange(n)]),
+        ('escape_packet', lambda n: [escape_bytewise(data) for _ in xrange(n)],
+         lambda n: [Protocol.escape_packet(data) for _ in xrange(n)]),
+        ('decode_packet', None, lambda n: [Protocol.decode_packet(frame) for _ in xrange(n)]),
+    ]
+    print "%-14s %14s %14s %8s" % ('', 'before/s', 'after/s', 'speedup')
+    for name, before, after in cases:
+        after_rate = timed(after, args.rounds)[1]
+        if before is not None:
+            before_rate = timed(before, args.rounds)[1]
+            print "%-14s %14.0f %14.0f %7.1fx" % (name, before_rate, after_rate, after_rate / before_rate)
+        else:
+            print "%-14s %14s %14.0f" % (name, '-', after_rate)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
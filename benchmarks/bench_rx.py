@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+# Micro-benchmark of the RX frame decoding. Compares the bulk FrameDecoder with pooled packet views against decoding
+# the stream byte by byte (the pre-FrameDecoder RxThread loop) on a recorded stream. Without a file a stream of log
+# packets is generated.
+#
+# Usage: python benchmarks/bench_rx.py [--chunk BYTES] [raw stream file, eg. a fuctlogger .bin]
+#
+
+__author__ = 'ari'
+
+import sys
+import time
+import random
+import itertools
+import argparse
+from os.path import join, dirname
+
+# prepend src path before systemwide path
+sys.path.insert(0, join(dirname(__file__), '..', 'src', 'main', 'python'))
+from fuct import rx
+from fuct.protocol import Protocol, PacketView
+
+
+def generate_stream(frames=20000, data_size=96, noise_rate=0.01):
+    """
+    Log packets with random data (so every frame has some escapes) and a little line noise in between
+    """
+    rnd = random.Random(5)
+    stream = bytearray()
+    for _ in xrange(frames):
+        data = bytearray(rnd.getrandbits(8) for _ in xrange(data_size))
+        stream += Protocol.create_packet(0x191, data=data, use_length=True)
+        if rnd.random() < noise_rate:
+            stream += bytearray(rnd.getrandbits(8) for _ in xrange(rnd.randint(1, 16)))
+    return str(stream)
+
+
+def decode_bytewise(chunks):
+    in_packet = False
+    in_escape = False
+    outbuf = bytearray()
+    frames = 0
+
+    for buf in chunks:
+        for c in buf:
+            if ord(c) == 0xAA:
+                if in_packet:
+                    in_escape = False
+                    outbuf = bytearray()
+                in_packet = True
+
+            elif ord(c) == 0xCC and in_packet:
+                in_packet = False
+                if len(outbuf) >= 4:
+                    checksum1 = outbuf.pop()
+                    if checksum1 == sum(outbuf) & 0xff:
+                        frames += 1
+                outbuf = bytearray()
+
+            else:
+                if in_packet and not in_escape:
+                    if ord(c) == 0xBB:
+                        in_escape = True
+                    else:
+                        outbuf += c
+
+                elif in_packet and in_escape:
+                    if ord(c) == 0x55:
+                        outbuf += chr(0xAA)
+                    elif ord(c) == 0x44:
+                        outbuf += chr(0xBB)
+                    elif ord(c) == 0x33:
+                        outbuf += chr(0xCC)
+                    in_escape = False
+    return frames
+
+
+def decode_bulk(chunks):
+    pool = rx.BufferPool()
+    decoder = rx.FrameDecoder(pool.acquire)
+    frames = 0
+    for buf in chunks:
+        for fbuf, size in decoder.feed(buf):
+            if size >= 4 and sum(itertools.islice(fbuf, size - 1)) & 0xff == fbuf[size - 1]:
+                PacketView(fbuf, size, pool).release()
+                frames += 1
+            else:
+                pool.release(fbuf)
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RX frame decoder benchmark')
+    parser.add_argument('--chunk', type=int, default=1024, help='serial read size in bytes (default: 1024)')
+    parser.add_argument('stream', nargs='?', help='recorded raw stream (default: generated log packets)')
+    args = parser.parse_args()
+
+    if args.stream is not None:
+        with open(args.stream, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = generate_stream()
+    chunks = [stream[i:i + args.chunk] for i in xrange(0, len(stream), args.chunk)]
+    print "Stream: %d bytes in %d byte chunks" % (len(stream), args.chunk)
+
+    results = {}
+    for name, func in (('bytewise', decode_bytewise), ('bulk', decode_bulk)):
+        best = None
+        for _ in xrange(3):
+            time1 = time.time()
+            frames = func(chunks)
+            elapsed = time.time() - time1
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = frames
+        print "%-10s %7d frames %8.3f s %10.0f frames/s %8.2f MB/s" % \
+              (name, frames, best, frames / best, len(stream) / best / 1000000)
+
+    if results['bytewise'] != results['bulk']:
+        print "Frame counts differ!"
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+# Micro-benchmark of the S19 parser. Compares the streaming batch parser against parsing line by line into a record
+# list (the pre-streaming parser) on a generated multi-megabyte S19 file.
+#
+# Usage: python benchmarks/bench_srecord.py [S19 file]
+#
+
+__author__ = 'ari'
+
+import os
+import sys
+import time
+import random
+import resource
+import tempfile
+from os.path import join, dirname
+
+# prepend src path before systemwide path
+sys.path.insert(0, join(dirname(__file__), '..', 'src', 'main', 'python'))
+from fuct import validator, pages
+
+
+def make_record(stype, address, data):
+    body = bytearray([len(address) + len(data) + 1]) + address + data
+    return stype + str(body + bytearray([(sum(body) & 0xFF) ^ 0xFF])).encode('hex').upper()
+
+
+def generate_s19(filepath, first_page=0x80, last_page=0xFF, record_size=32):
+    rnd = random.Random(4)
+    with open(filepath, 'w') as f:
+        f.write(make_record('S0', bytearray(2), bytearray('fuct benchmark')) + '\n')
+        for page in xrange(first_page, last_page + 1):
+            for addr in xrange(0x8000, 0xC000, record_size):
+                data = bytearray(rnd.getrandbits(8) for _ in xrange(record_size))
+                f.write(make_record('S2', bytearray([page, addr >> 8, addr & 0xFF]), data) + '\n')
+        f.write(make_record('S8', bytearray(3), bytearray()) + '\n')
+
+
+def parse_listed(filepath):
+    records = [validator.parse_line(line) for line in open(filepath).read().splitlines()]
+    return pages.records_to_image(records[1:-1])
+
+
+def parse_streamed(filepath):
+    return validator.verify_firmware(filepath, pages.FlashImage()).image
+
+
+def measure(func, filepath, rounds=3):
+    """
+    Runs func in a forked child so the peak RSS growth of every parser is measured separately
+    """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        best = None
+        for _ in xrange(rounds):
+            time1 = time.time()
+            image = func(filepath)
+            elapsed = time.time() - time1
+            best = elapsed if best is None else min(best, elapsed)
+            del image
+        rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start
+        os.write(wfd, "%f %d" % (best, rss_growth))
+        os._exit(0)
+    os.close(wfd)
+    result = os.read(rfd, 64).split()
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return float(result[0]), int(result[1])
+
+
+def main():
+    if len(sys.argv) > 1:
+        filepath = sys.argv[1]
+        cleanup = False
+    else:
+        filepath = join(tempfile.gettempdir(), 'fuct-bench.s19')
+        generate_s19(filepath)
+        cleanup = True
+
+    size = os.path.getsize(filepath)
+    print "S19 file: %s (%.1f MB)" % (filepath, float(size) / 1000000)
+    results = []
+    for name, func in (('listed', parse_listed), ('streamed', parse_streamed)):
+        elapsed, rss = measure(func, filepath)
+        results.append(elapsed)
+        print "%-10s %7.3f s %7.2f MB/s  peak RSS +%d kB" % (name, elapsed, float(size) / elapsed / 1000000, rss)
+    print "speedup    %7.2fx" % (results[0] / results[1])
+
+    if cleanup:
+        os.remove(filepath)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,13 +13,23 @@ import textwrap
 import logging
 import sys
 import time
+import copy
+import glob
+import hashlib
+import threading
+import concurrent.futures as futures
 from serial.serialutil import SerialException
-from fuct import common, log, serialmonitor, validator, pages, __version__, __git__
+from fuct import common, log, serialmonitor, validator, pages, cache, timing, journal, rip, __version__, __git__
 
 LOG = log.fuct_logger('fuctlog')
+DEFAULT_BAUD = 115200
+CALIBRATION_BAUDS = (230400, 460800)
+PARALLEL_COMMANDS = ('load', 'fastload', 'diffload', 'verify', 'erase', 'rip')
 
 
 class CmdHandler:
+    _firmware = {}  # Parsed firmware shared by parallel workers
+    _firmware_lock = threading.Lock()
 
     def __init__(self):
         pass
@@ -36,9 +46,10 @@ class CmdHandler:
         return all(c < 128 for c in s)
 
     @staticmethod
-    def get_device(port):
+    def get_device(port, use_profile=True):
         LOG.info("Checking device...")
-        dev = serialmonitor.SMDevice(port)
+        profile = timing.load_profile(port.port) if use_profile else None
+        dev = serialmonitor.SMDevice(port, profile)
         if dev.reinit() is not None:
             if dev.check_device:
                 return dev
@@ -51,19 +62,12 @@ class CmdHandler:
     def do_check(params):
         if params[1] is not None:
             if os.path.isfile(params[1]) and os.access(params[1], os.R_OK):
-                LOG.info("Checking firmware...")
-                records = validator.verify_firmware(params[1])
-                if records:
-                    LOG.info("Parsed %d records" % len(records))
-                    if records[0].stype[0] == 'S0':
-                        header = records[0].data if CmdHandler.is_ascii(records[0].data) else "[binary data]"
-                        LOG.info("Header info: [%s]" % header)
-                    else:
-                        LOG.warning("No header...")
-                    LOG.info("File OK")
-                    return True
+                firmware = CmdHandler.load_firmware(params[1], not params[2].no_cache)
+                if firmware.header is not None:
+                    LOG.info("Header info: [%s]" % CmdHandler.header_info(firmware.header))
                 else:
-                    return False
+                    LOG.warning("No header...")
+                return True
             else:
                 raise ValueError('Cannot find firmware file or no read access')
 
@@ -80,37 +84,166 @@ class CmdHandler:
         raise ValueError('serial port argument cannot be empty')
 
     @staticmethod
-    def do_load(params, verify=True):
-        if params[0] is not None and params[1] is not None:
+    def header_info(header):
+        if header is None:
+            return "[no header]"
+        return str(header.data) if CmdHandler.is_ascii(header.data) else "[binary data]"
+
+    @staticmethod
+    def load_firmware(filepath, use_cache=True):
+        with CmdHandler._firmware_lock:
+            memo_key = (os.path.realpath(filepath), os.path.getmtime(filepath))
+            firmware = CmdHandler._firmware.get(memo_key)
+            if firmware is None:
+                firmware = CmdHandler._firmware[memo_key] = CmdHandler.parse_firmware(filepath, use_cache)
+            return firmware
+
+    @staticmethod
+    def parse_firmware(filepath, use_cache=True):
+        fwcache = cache.FirmwareCache() if use_cache else None
+        key = firmware = None
+        if fwcache is not None:
+            key = fwcache.key(filepath)
+            firmware = fwcache.load(key)
+            if firmware is not None:
+                LOG.info("Using cached firmware image (%s)" % key[:12])
+
+        if firmware is None:
             LOG.info("Checking firmware file...")
-            records = validator.verify_firmware(params[1])
-            if records is None:
+            firmware = validator.verify_firmware(filepath, pages.FlashImage())
+            if firmware is None:
                 raise ValueError('Firmware file is corrupt or has no records, won\'t load')
-            LOG.info("File OK, got %d records" % len(records))
+            if fwcache is not None:
+                fwcache.store(key, firmware)
+
+        image = firmware.image
+        LOG.info("File OK, got %d records" % firmware.records)
+        LOG.info("Received %d pages, %d bytes in %d blocks" % (len(image), image.size, image.block_count()))
+        return firmware
+
+    @staticmethod
+    def diff_pages(dev, image):
+        """
+        Reads every page used by the image once and compares it against the image by hash. The image page holds
+        the erased value outside of the firmware data so a match means the page is identical to a fresh load.
+        Returns a list of (page number, match) tuples in load order.
+        """
+        result = []
+        image_pages = image.pages()
+        for i, page in enumerate(image_pages):
+            common.check_stop()
+            match = hashlib.sha1(dev.read_page(page)).digest() == image.page_digest(page)
+            LOG.debug("Page 0x%02x %s" % (page, "matches" if match else "differs"))
+            result.append((page, match))
+            common.print_progress(float(i + 1) / len(image_pages))
+
+        sys.stdout.write("\r")
+        sys.stdout.flush()
+        return result
+
+    @staticmethod
+    def report_erase_times(erase_times):
+        if erase_times:
+            times_ms = [t * 1000 for _, t in erase_times]
+            LOG.info("Erased %d pages in %.2f sec (min %d ms, avg %d ms, max %d ms)" %
+                     (len(times_ms), sum(times_ms) / 1000, min(times_ms), sum(times_ms) / len(times_ms), max(times_ms)))
+            LOG.info("Page erase times: %s" % ", ".join("0x%02x %d ms" % (page, t * 1000) for page, t in erase_times))
+
+    @staticmethod
+    def open_journal(dev, filepath, image, pagelist, resume=False, tag=None):
+        """
+        Returns the load journal and the pages still to load. When resuming, the pages an interrupted load already
+        finished get a quick check against the image and are skipped if they still match.
+        """
+        image_key = cache.FirmwareCache.key(filepath)
+        jrnl = None
+        if resume:
+            jrnl = journal.LoadJournal.open(filepath, image_key, tag)
+            if jrnl is None:
+                LOG.info("Nothing to resume, loading all pages")
+            else:
+                done = [page for page in pagelist if jrnl.done(page)]
+                LOG.info("Resuming load, checking %d pages loaded earlier..." % len(done))
+                for page in done:
+                    if not dev.page_matches(image, page, quick=True):
+                        LOG.warning("Page 0x%02x does not match the firmware anymore, reloading it" % page)
+                        jrnl.forget(page)
+                pagelist = [page for page in pagelist if not jrnl.done(page)]
+                LOG.info("%d pages left to load" % len(pagelist))
+        elif journal.LoadJournal.exists(filepath, image_key, tag):
+            LOG.warning("Previous load of this file was interrupted, starting over (use --resume to continue it)")
+
+        if jrnl is None:
+            jrnl = journal.LoadJournal.for_firmware(filepath, image_key, tag)
+        jrnl.save()  # Before anything is erased, so an unwritable journal cannot stop a load halfway
+        return jrnl, pagelist
+
+    @staticmethod
+    def do_load(params, verify=True, diff=False):
+        if params[0] is not None and params[1] is not None:
+            firmware = CmdHandler.load_firmware(params[1], not params[2].no_cache)
+            image = firmware.image
 
             dev = CmdHandler.get_device(params[0])
 
-            LOG.info("Converting records to memory pages...")
-            header = records.pop(0)  # S0 Record
-            termination = records.pop()  # S8 Record
-            pagedata = pages.records_to_pages(records)
-            pagelist = pagedata[0]
-            LOG.info("Received %d pages" % len(pagelist))
-            LOG.info("Loading firmware: '%s'" % str(header.data))
+            pagelist = image.pages()
+            if diff:
+                LOG.info("Comparing device pages against firmware...")
+                time1 = time.time()
+                compared = CmdHandler.diff_pages(dev, image)
+                compare_time = time.time() - time1
+                skipped = [page for page, match in compared if match]
+                pagelist = [page for page, match in compared if not match]
+                LOG.info("%d of %d pages differ (compared in %.2f sec)" % (len(pagelist), len(compared), compare_time))
+                if not pagelist:
+                    LOG.info("Device already contains the firmware, nothing to load")
+
+            jrnl, pagelist = CmdHandler.open_journal(dev, params[1], image, pagelist, params[2].resume, params[2].tag)
+
+            LOG.info("Loading firmware: '%s'" % CmdHandler.header_info(firmware.header))
+
+            time1 = time.time()
+            erase = True
+            if not diff and not jrnl.pages and dev.prefer_bulk_erase(len(pagelist)):
+                LOG.info("Firmware uses %d pages, bulk erasing the device" % len(pagelist))
+                bulk_time = dev.erase_all()
+                if bulk_time is not None:
+                    LOG.info("Bulk erase done (%d ms)" % (bulk_time * 1000))
+                    erase = False
+                else:
+                    LOG.warning("Bulk erase failed, erasing page by page")
 
-            last_page = None
-            loaded_size = 0
+            total_blocks = sum(image.block_count(page) for page in pagelist)
+            loaded_blocks = 0
+            erase_times = []
             for page in pagelist:
-                page_size = len(page.data)
-                LOG.debug("%6d bytes to 0x%02x @ 0x%04x" % (page_size, page.page, page.address))
-                dev.erase_and_write(page, erase=False if page.page == last_page else True, verify=verify)
-                last_page = page.page
-                loaded_size += page_size
-                common.print_progress(float(loaded_size) / pagedata[1])
+                common.check_stop()
+                blocks = image.block_count(page)
+                LOG.debug("%3d blocks to page 0x%02x" % (blocks, page))
+                jrnl.mark(page, jrnl.LOADING)
+                erase_time = dev.write_page(image, page, erase=erase, verify=verify)
+                jrnl.mark(page, jrnl.VERIFIED if verify else jrnl.WRITTEN)
+                if erase_time is not None:
+                    erase_times.append((page, erase_time))
+                loaded_blocks += blocks
+                common.print_progress(float(loaded_blocks) / total_blocks if total_blocks else 1.0)
 
             sys.stdout.write("\r")
             sys.stdout.flush()
-            LOG.info("Firmware loaded successfully")
+            load_time = time.time() - time1
+            jrnl.remove()
+            LOG.info("Firmware loaded successfully (%.2f sec)" % load_time)
+            CmdHandler.report_erase_times(erase_times)
+
+            if diff and skipped:
+                skipped_blocks = sum(image.block_count(page) for page in skipped)
+                if loaded_blocks:
+                    saved = load_time * skipped_blocks / loaded_blocks
+                else:
+                    saved = dev.estimate_write_time(skipped_blocks * image.BLOCK_SIZE, len(skipped), verify)
+                LOG.info("Skipped %d unchanged pages (%d blocks): %s" %
+                         (len(skipped), skipped_blocks, ", ".join("0x%02x" % page for page in skipped)))
+                LOG.info("Estimated time saved: %.2f sec (%.2f sec net of comparing)" % (saved, saved - compare_time))
 
             return True
 
@@ -121,13 +254,111 @@ class CmdHandler:
         CmdHandler.do_load(params, False)
         return True
 
+    @staticmethod
+    def do_diffload(params):
+        return CmdHandler.do_load(params, diff=True)
+
+    @staticmethod
+    def do_verify(params):
+        if params[0] is not None and params[1] is not None:
+            image = CmdHandler.load_firmware(params[1], not params[2].no_cache).image
+            dev = CmdHandler.get_device(params[0])
+
+            LOG.info("Verifying device pages against firmware...")
+            compared = CmdHandler.diff_pages(dev, image)
+            differs = [page for page, match in compared if not match]
+            if differs:
+                LOG.error("%d of %d pages differ: %s" %
+                          (len(differs), len(compared), ", ".join("0x%02x" % page for page in differs)))
+                return False
+
+            LOG.info("All %d pages match the firmware" % len(compared))
+            return True
+
+        raise ValueError('Verify needs both serial port and firmware file')
+
+    @staticmethod
+    def calibrate_link(dev):
+        LOG.info("Calibrating at %d baud..." % dev.baudrate)
+        profile, measurements = dev.calibrate()
+        LOG.info("  size   read ms  write ms    kB/s")
+        for size, read_time, write_time in measurements:
+            LOG.info("  %4d  %8.2f  %8.2f  %6.2f" %
+                     (size, read_time * 1000, write_time * 1000, 2 * size / (read_time + write_time) / 1000))
+        LOG.info("%d baud: %d ns/byte, %.2f ms latency, %d ms timeout" %
+                 (profile['baud'], profile['ns_per_byte'], profile['latency_ms'], profile['timeout_ms']))
+        return profile
+
+    @staticmethod
+    def do_calibrate(params):
+        if params[0] is not None:
+            ser = params[0]
+            base_baud = ser.baudrate
+            profiles = [CmdHandler.calibrate_link(CmdHandler.get_device(ser, use_profile=False))]
+
+            for baud in CALIBRATION_BAUDS:
+                if baud <= base_baud:
+                    continue
+                ser.baudrate = baud
+                dev = serialmonitor.SMDevice(ser)
+                if dev.reinit() is None:
+                    LOG.info("Serial monitor does not answer at %d baud" % baud)
+                    continue
+                profiles.append(CmdHandler.calibrate_link(dev))
+
+            ser.baudrate = base_baud
+            serialmonitor.SMDevice(ser).reinit()
+
+            best = profiles[0]
+            for profile in profiles[1:]:
+                if profile['ns_per_byte'] < best['ns_per_byte'] * 0.9:  # Only switch baud if it really pays off
+                    best = profile
+            key = timing.save_profile(ser.port, best)
+            LOG.info("Saved %d baud timing profile for %s" % (best['baud'], key))
+            return True
+
+        raise ValueError('serial port argument cannot be empty')
+
+    @staticmethod
+    def do_purge(params):
+        fwcache = cache.FirmwareCache()
+        if params[1] is not None:
+            if not os.path.isfile(params[1]):
+                raise ValueError('Cannot find firmware file')
+            removed = fwcache.invalidate(fwcache.key(params[1]))
+        else:
+            removed = fwcache.invalidate()
+        LOG.info("Removed %d cached firmware image(s) from %s" % (removed, fwcache.path))
+        return True
+
     @staticmethod
     def do_rip(params):
-        filename = "rip-%s.bin" % time.strftime("%Y%m%d-%H%M%S")
         if params[0] is not None:
+            args = params[2]
             dev = CmdHandler.get_device(params[0])
-            LOG.info("Ripping pages from 0xE0 to 0xFF")
-            dev.rip_pages(0xE0, 0xFF, filename)
+            if params[1] is not None:
+                pagelist = CmdHandler.load_firmware(params[1], not args.no_cache).image.pages()
+                LOG.info("Ripping %d pages used by the firmware" % len(pagelist))
+            else:
+                pagelist = range(dev.FIRST_PAGE, dev.LAST_PAGE + 1)
+                LOG.info("Ripping pages from 0x%02x to 0x%02x" % (dev.FIRST_PAGE, dev.LAST_PAGE))
+
+            filename = "rip-%s%s.%s" % (time.strftime("%Y%m%d-%H%M%S"), '-' + args.tag if args.tag else '', args.format)
+            writer = rip.RipWriter(filename, args.format)
+            writer.start()
+            time1 = time.time()
+            try:
+                dev.rip_pages(pagelist, writer)
+            finally:
+                digest = writer.close()
+            sys.stdout.write("\r")
+            sys.stdout.flush()
+
+            stats = writer.stats
+            LOG.info("Firmware ripped to %s (%.2f sec)" % (filename, time.time() - time1))
+            LOG.info("Skipped %d blank pages and %d blank blocks, %d bytes written" %
+                     (stats['blank_pages'], stats['blank_blocks'], stats['bytes']))
+            LOG.debug("Rip SHA-256: %s" % digest)
             return True
 
         raise ValueError('serial port argument cannot be empty')
@@ -136,14 +367,132 @@ class CmdHandler:
     def do_erase(params):
         if params[0] is not None:
             dev = CmdHandler.get_device(params[0])
-            LOG.info("Erasing pages from 0xE0 to 0xFF")
-            resp = dev.erase_pages(0xE0, 0xFF)  # TODO: get pages from device info
+            if params[1] is not None:
+                erase_list = CmdHandler.load_firmware(params[1], not params[2].no_cache).image.pages()
+                LOG.info("Erasing %d pages used by the firmware" % len(erase_list))
+            else:
+                # TODO: get pages from device info
+                erase_list = range(dev.FIRST_PAGE, dev.LAST_PAGE + 1)
+                if dev.prefer_bulk_erase(len(erase_list)):
+                    LOG.info("Bulk erasing pages from 0x%02x to 0x%02x" % (dev.FIRST_PAGE, dev.LAST_PAGE))
+                    bulk_time = dev.erase_all()
+                    if bulk_time is not None:
+                        LOG.info("Firmware erased successfully (%d ms)" % (bulk_time * 1000))
+                        return True
+                    LOG.warning("Bulk erase failed, erasing page by page")
+                LOG.info("Erasing pages from 0x%02x to 0x%02x" % (dev.FIRST_PAGE, dev.LAST_PAGE))
+
+            CmdHandler.report_erase_times(dev.erase_pages(erase_list))
 
             return True
 
         raise ValueError('serial port argument cannot be empty')
 
 
+def expand_ports(values):
+    """
+    Expands repeated, comma separated and wildcard port arguments into a list of port names
+    """
+    ports = []
+    for value in values or []:
+        for name in value.split(','):
+            names = sorted(glob.glob(name)) if glob.has_magic(name) else [name]
+            ports.extend(n for n in names if n and n not in ports)
+    return ports
+
+
+def open_port(port, baud=None):
+    if baud is None:
+        profile = timing.load_profile(port)
+        baud = profile['baud'] if profile is not None else DEFAULT_BAUD
+    LOG.info("Opening port %s (%d baud)" % (port, baud))
+    ser = serial.Serial(port, baud, timeout=0.02, bytesize=8, parity=serial.PARITY_NONE, stopbits=1)
+    LOG.debug(ser)
+    return ser
+
+
+def run_worker(port, args, view):
+    tag = os.path.basename(port)
+    threading.current_thread().name = tag
+    common.set_progress_view(view, tag)
+    worker_args = copy.copy(args)
+    worker_args.tag = tag
+
+    time1 = time.time()
+    ser = None
+    try:
+        ser = open_port(port, args.baud)
+        ok = CmdHandler().lookup_method(args.command)((ser, args.firmware, worker_args))
+        error = None if ok else "command failed"
+    except KeyboardInterrupt:
+        ok = False
+        error = "interrupted"
+    except (AttributeError, ValueError, IOError, OSError), ex:
+        ok = False
+        error = str(ex)
+        LOG.error(error)
+    except Exception, ex:  # One broken worker must not take the summary of the others with it
+        ok = False
+        error = "%s: %s" % (type(ex).__name__, ex)
+        LOG.exception(error)
+    finally:
+        if ser is not None:
+            ser.close()
+    view.update(tag, 1.0)
+    return ok, time.time() - time1, error
+
+
+def wait_jobs(jobs):
+    """
+    Waits for the workers in short steps, a plain result() cannot be interrupted with Ctrl+C on Python 2
+    """
+    pending = [job for _, job in jobs]
+    while pending:
+        pending = futures.wait(pending, timeout=0.2).not_done
+
+
+def run_parallel(args, ports):
+    """
+    Runs the command on every port at the same time, one worker thread per port. The firmware is parsed once and
+    shared by the workers. Ctrl+C stops every worker after its current page.
+    """
+    if args.command.lower() not in PARALLEL_COMMANDS:
+        raise ValueError('Command "%s" can only be run on a single port' % args.command)
+
+    log.fuct_logger('fuctlog', threads=True)
+    if args.debug:
+        LOG.setLevel(logging.DEBUG)
+    if args.firmware is not None:
+        CmdHandler.load_firmware(args.firmware, not args.no_cache)
+
+    LOG.info("Running '%s' on %d devices: %s" % (args.command, len(ports), ", ".join(ports)))
+    view = common.MultiProgress([os.path.basename(port) for port in ports])
+    time1 = time.time()
+    executor = futures.ThreadPoolExecutor(max_workers=len(ports))
+    common.request_stop(False)
+    jobs = [(port, executor.submit(run_worker, port, args, view)) for port in ports]
+    try:
+        wait_jobs(jobs)
+    except KeyboardInterrupt:
+        LOG.warning("Interrupted, stopping the devices after their current page")
+        common.request_stop()
+        wait_jobs(jobs)
+    results = [(port, job.result()) for port, job in jobs]
+    executor.shutdown()
+    total_time = time.time() - time1
+
+    sys.stdout.write("\n")
+    LOG.info("Summary:")
+    for port, (ok, elapsed, error) in results:
+        if ok:
+            LOG.info("  %-20s OK      %7.2f sec" % (port, elapsed))
+        else:
+            LOG.error("  %-20s FAILED  %7.2f sec  %s" % (port, elapsed, error))
+    slowest = max(elapsed for _, (_, elapsed, _) in results)
+    LOG.info("Station time %.2f sec for %d devices (slowest device %.2f sec)" % (total_time, len(ports), slowest))
+    return all(ok for _, (ok, _, _) in results)
+
+
 def execute():
     parser = argparse.ArgumentParser(
         prog='fuctloader',
@@ -153,11 +502,18 @@ def execute():
     validate S19 files and of course load, verify, rip and erase firmware data. You can also rip the serial
     monitor for further analysis.
 
-    Example: fuctloader -s /dev/ttyUSB0 load testcar1-firmware.S19''' % (__version__, __git__),
+    Example: fuctloader -s /dev/ttyUSB0 load testcar1-firmware.S19
+             fuctloader -s '/dev/ttyUSB*' load testcar1-firmware.S19  (all matching devices in parallel)''' % (__version__, __git__),
         formatter_class=argparse.RawTextHelpFormatter,)
     parser.add_argument('-v', '--version', action='store_true', help='show program version')
     parser.add_argument('-d', '--debug', action='store_true', help='show debug information')
-    parser.add_argument('-s', '--serial', nargs='?', help='serialport device (eg. /dev/xxx, COM1)')
+    parser.add_argument('-s', '--serial', action='append',
+                        help='serialport device (eg. /dev/xxx, COM1), repeat or use commas/wildcards for several devices')
+    parser.add_argument('-b', '--baud', type=int, help='serial baud rate (default: calibrated profile or %d)' % DEFAULT_BAUD)
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted load from the first incomplete page')
+    parser.add_argument('--format', choices=rip.RipWriter.FORMATS, default='s19',
+                        help='rip output format, S19 or sparse binary (default: s19)')
+    parser.add_argument('--no-cache', action='store_true', help='always parse the firmware file, skip the cache')
     parser.add_argument(
         'command',
         nargs='?',
@@ -168,8 +524,12 @@ def execute():
         device     poll device for correct device ID and serial monitor
         load       validate, load and verify firmware file into device
         fastload   load firmware file into device without any validation
-        rip        rip firmware from device
-        erase      erase device (serial monitor is not erased)
+        diffload   load only the pages that differ from the firmware file
+        verify     compare device against firmware file (read only)
+        rip        rip firmware (or only the pages used by the firmware file) from device into S19
+        erase      erase device or only the pages used by the firmware file (serial monitor is not erased)
+        calibrate  measure serial link timing and save it as the profile for the adapter
+        purge      remove firmware file (or all files) from the parsed firmware cache
 
         '''))
     parser.add_argument('firmware', nargs='?', help='location and name of the S19 firmware file')
@@ -182,13 +542,19 @@ def execute():
         LOG.info("FUCT - fuctloader %s (Git: %s)" % (__version__, __git__))
         try:
             ser = None
+            args.tag = None
             if args.debug:
                 LOG.setLevel(logging.DEBUG)
-            if args.serial is not None:
-                LOG.info("Opening port %s" % args.serial)
-                ser = serial.Serial(args.serial, 115200, timeout=0.02, bytesize=8, parity=serial.PARITY_NONE, stopbits=1)
-                LOG.debug(ser)
-            if CmdHandler().lookup_method(args.command)((ser, args.firmware)):
+            ports = expand_ports(args.serial)
+            if args.serial is not None and not ports:
+                raise ValueError('No serial ports match %s' % ", ".join(args.serial))
+            if len(ports) > 1:
+                ok = run_parallel(args, ports)
+            else:
+                if ports:
+                    ser = open_port(ports[0], args.baud)
+                ok = CmdHandler().lookup_method(args.command)((ser, args.firmware, args))
+            if ok:
                 LOG.info("Exiting...")
             else:
                 LOG.error("Exiting on error")
@@ -198,7 +564,11 @@ def execute():
             LOG.error(ex.message)
         except SerialException, ex:
             LOG.error("Serial: " + ex.message)
+        except IOError, ex:
+            LOG.error("IO: %s" % ex)
         except OSError, ex:
             LOG.error("OS: " + ex.message)
+        except KeyboardInterrupt:
+            LOG.warning("Interrupted")
     else:
         parser.print_usage()
@@ -7,38 +7,100 @@
 __author__ = 'ari'
 
 import sys
+import zlib
 import logging
 import argparse
 import serial
 import time
 import math
 import os
-import Queue
 import json
 import binascii
 import bz2
-import concurrent.futures as futures
 from serial.serialutil import SerialException
-from fuct import log, rx, interrogator, __version__, __git__
+from fuct import log, rx, common, interrogator, cache, snapshot, client as fuct_client, __version__, __git__
 
 LOG = log.fuct_logger('fuctlog')
 QUEUE_SIZE_LOG = 50
-
-
-def compress_file(filename):
-    comp = bz2.BZ2Compressor()
-    src = file(filename, "r")
-    dst = file(filename + ".bz2", "w")
-    block = src.read(2048)
-    while block:
-        cblock = comp.compress(block)
-        dst.write(cblock)
-        block = src.read(2048)
-    cblock = comp.flush()
-    dst.write(cblock)
-    src.close()
-    dst.close()
-    os.remove(filename)
+BUFFER_SIZE = 64 * 1024
+WRITE_ALIGN = 4096
+FLUSH_INTERVAL = 1.0  # Seconds the data may stay in the buffer
+STATUS_INTERVAL = 0.25
+READ_TIMEOUT = 0.1
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+class RawCompressor(object):
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return ''
+
+
+class CompressWriter(common.QueueWriter):
+    """
+    Compresses the log stream into filepath + the codec extension on its own thread, so the logging loop only queues
+    its buffers and stopping needs just the final flush. bz2 output is what the OLV/ULV viewers read, zlib (gzip
+    format) takes the least CPU and lzma (xz, needs Python 3 or backports.lzma) compresses the best.
+    """
+    CODECS = {
+        # codec: (extension, default level, min level, max level)
+        'bz2': ('.bz2', 9, 1, 9),
+        'zlib': ('.gz', 6, 0, 9),
+        'lzma': ('.xz', 6, 0, 9),
+        'none': ('', 0, 0, 0),
+    }
+
+    def __init__(self, filepath, codec='bz2', level=None, queue_size=64):
+        if codec not in self.CODECS:
+            raise ValueError('Unknown compression codec "%s"' % codec)
+        ext, default, lowest, highest = self.CODECS[codec]
+        level = level if level is not None else default
+        if not lowest <= level <= highest:
+            raise ValueError('Invalid %s compression level %d, use %d-%d' % (codec, level, lowest, highest))
+        if codec == 'lzma' and lzma is None:
+            raise ValueError('lzma compression needs the backports.lzma package on Python 2')
+
+        super(CompressWriter, self).__init__(queue_size)
+        self.filepath = filepath + ext
+        self.codec = codec
+        self.level = level
+        self._file = open(self.filepath, 'wb')
+        self._compressor = self.__compressor()
+
+    def write(self, data):
+        """
+        Queues data for compression. The writer takes ownership of data.
+        """
+        self.put(data)
+
+    def handle(self, data):
+        self._file.write(self._compressor.compress(data))
+
+    def end(self):
+        self._file.write(self._compressor.flush())
+
+    def release(self):
+        self._file.close()
+
+    # -----
+
+    def __compressor(self):
+        if self.codec == 'bz2':
+            return bz2.BZ2Compressor(self.level)
+        if self.codec == 'zlib':
+            return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip header and trailer
+        if self.codec == 'lzma':
+            return lzma.LZMACompressor(preset=self.level)
+        return RawCompressor()
 
 
 def create_filename(prefix, path, tstamp=time.strftime("%Y%m%d-%H%M%S"), ext="bin", identifier="none"):
@@ -68,6 +130,109 @@ def busy_icon():
             yield cursor
 
 
+class LogRecorder(object):
+    """
+    The logging loop. The port is read with large readinto() calls into a preallocated buffer, which goes to disk when
+    it is full or FLUSH_INTERVAL has passed (in WRITE_ALIGN multiples, the rest waits for the next write). The file
+    size is counted in memory and the status line is updated at most every STATUS_INTERVAL seconds.
+
+    The logfiles are compressed as they are written (see CompressWriter), a new one (basename.1, basename.2, ...) is
+    started when the uncompressed size limit is exceeded.
+    """
+
+    def __init__(self, ser, basename, sizelimit, codec='bz2', level=None, buffer_size=BUFFER_SIZE, status=True):
+        self.ser = ser
+        self.basename = basename
+        self.sizelimit = sizelimit
+        self.codec = codec
+        self.level = level
+        self.status = status
+        self.buffer = bytearray(buffer_size)
+        self.logfile = self.__open(basename)
+        self.size = 0  # Uncompressed bytes in the current logfile
+        self._finishing = []  # Rotated writers still compressing
+        self.total = 0  # Bytes received
+        self._view = memoryview(self.buffer)
+        self._fill = 0
+        self._counter = 1
+
+    def run(self, limit=None):
+        """
+        Logs until interrupted (or limit bytes have been received). Whatever way the loop ends the buffered data is
+        written out.
+        """
+        ser = self.ser
+        view = self._view
+        buffer_size = len(self.buffer)
+        spinner = busy_icon()
+        now = time.time()
+        next_flush = now + FLUSH_INTERVAL
+        next_status = now
+        status_time, status_total = now, 0
+
+        try:
+            while limit is None or self.total < limit:
+                n = ser.readinto(view[self._fill:])
+                self._fill += n
+                self.total += n
+                if self._fill == buffer_size:
+                    self.__write(buffer_size)
+
+                now = time.time()
+                if now >= next_flush:
+                    self.__write(self._fill - self._fill % WRITE_ALIGN)
+                    next_flush = now + FLUSH_INTERVAL
+                if self.status and now >= next_status:
+                    rate = (self.total - status_total) / (now - status_time) if now > status_time else 0.0
+                    sys.stdout.write("\r%s %.1f kB/s " % (spinner.next(), rate / 1000))
+                    sys.stdout.flush()
+                    status_time, status_total = now, self.total
+                    next_status = now + STATUS_INTERVAL
+        finally:
+            self.__write(self._fill)  # The data received since the last write, also when the port fails
+
+    def close(self):
+        """
+        Writes out the buffer, flushes the compression and closes the logfile. Returns its name.
+        """
+        try:
+            self.__write(self._fill)
+        finally:
+            self.logfile.close()
+            for writer in self._finishing:
+                writer.join()
+        if self.status:
+            sys.stdout.write('\n')
+        return self.logfile.filepath
+
+    # -----
+
+    def __open(self, logname):
+        writer = CompressWriter(logname, self.codec, self.level)
+        writer.start()
+        return writer
+
+    def __write(self, n):
+        if not n:
+            return
+        self.logfile.write(self._view[:n].tobytes())
+        rest = self._fill - n
+        if rest:
+            self.buffer[:rest] = self._view[n:self._fill]
+        self._fill = rest
+        self.size += n
+
+        if self.size >= self.sizelimit:
+            self.logfile.close(wait=False)
+            self._finishing = [w for w in self._finishing if w.is_alive()] + [self.logfile]
+            self.logfile = self.__open("%s.%d" % (self.basename, self._counter))
+            self.size = 0
+            self._counter += 1
+            if self.status:
+                sys.stdout.write('\n')
+            LOG.info("=> %s" % self.logfile.filepath)
+
+
 def execute():
     parser = argparse.ArgumentParser(
         prog='fuctlogger',
@@ -85,15 +250,29 @@ def execute():
     parser.add_argument('-p', '--path', nargs='?', help='path for the logfile (default: ./)')
     parser.add_argument('-x', '--prefix', nargs='?', help='prefix for the logfile name (default: log)')
     parser.add_argument('-s', '--size', nargs='?', help='size of single logfile with unit (xxM/xxG) (default 128M)')
+    parser.add_argument('-c', '--codec', choices=sorted(CompressWriter.CODECS), default='bz2',
+                        help='logfile compression, bz2 is read by OLV/ULV, zlib is the lightest (default: bz2)')
+    parser.add_argument('-l', '--level', type=int, help='compression level (default: 9 for bz2, 6 for zlib/lzma)')
+    parser.add_argument('-w', '--window', type=int, default=interrogator.Interrogator.WINDOW,
+                        help='interrogation requests in flight (default: %d)' % interrogator.Interrogator.WINDOW)
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help='interrogate the device fully and replace the cached interrogation of its firmware')
+    parser.add_argument('--read-ram', action='store_true',
+                        help='read the RAM contents also when the interrogation is cached (slower start)')
+    parser.add_argument('--purge-cache', action='store_true', help='remove all cached interrogations and exit')
     parser.add_argument('serial', nargs='?', help='serialport device (eg. /dev/xxx, COM1)')
 
     args = parser.parse_args()
 
     if args.version:
         print "fuctlogger %s (Git: %s)" % (__version__, __git__)
+    elif args.purge_cache:
+        icache = cache.InterrogationCache()
+        LOG.info("Removed %d cached interrogation(s) from %s" % (icache.invalidate(), icache.path))
     elif args.serial is not None:
         LOG.info("FUCT - fuctlogger %s (Git: %s)" % (__version__, __git__))
-        ser = logfile = None
+        ser = recorder = client = None
+        stopped = False
         try:
             if args.debug:
                 LOG.setLevel(logging.DEBUG)
@@ -105,84 +284,65 @@ def execute():
             file_identifier = binascii.hexlify(os.urandom(3))
             timestamp = time.strftime("%Y%m%d-%H%M%S")
 
-            basename = logname = create_filename(args.prefix, args.path, tstamp=timestamp, identifier=file_identifier)
-            LOG.info("Opening logfile: %s" % logname)
-            logfile = open(logname, 'w+')
-
+            sizelimit = convert_sizelimit(args.size) if args.size is not None else 128000000
             metaname = create_filename("meta", args.path, ext="json", tstamp=timestamp, identifier=file_identifier)
             LOG.info("Opening metafile: %s" % metaname)
             metafile = open(metaname, 'w+')
 
-            queue_in = Queue.Queue(0)
-            queue_out = Queue.Queue(0)
-
-            executor = futures.ThreadPoolExecutor(max_workers=1)
-
-            ser.timeout = 0
-            rxThread = rx.RxThread(ser, queue_in)
-            rxThread.buffer_size = 64
-            rxThread.start()
+            ser.timeout = 0.1
+            client = fuct_client.Client(ser).start()
 
             # interrogation
             time1 = time.time()
-            i = interrogator.Interrogator(ser, queue_in, queue_out)
-            meta = i.get_metadata()
+            i = interrogator.Interrogator(client, window=args.window)
             LOG.info("Reading metadata and location IDs")
+            meta = i.get_metadata()
             meta_out = {'firmware': meta[0]}
 
-            LOG.info("Reading location data")
-            for lid in meta[1]:
-                info = i.get_location_info(lid)
-                if info.ram_page > 0:
-                    ram_data = i.get_ram_data((lid, 0), info.size)
-                    # FIXME: store data to json?
-                if info.flash_page > 0:
-                    flash_data = i.get_flash_data((lid, 0), info.size)
-                    # FIXME: store data to json?
+            icache = cache.InterrogationCache()
+            key = icache.key(meta[0])
+            if args.refresh_cache:
+                icache.invalidate(key)
+            cached = icache.load(*meta)
+            snapflags = 0
+            if cached is not None:
+                LOG.info("Using cached location table and flash contents (%s)" % key[:12])
+                locations = i.interrogate(meta[1], cached=cached, read_ram=args.read_ram)
+                meta_out['interrogation_cache'] = key
+                snapflags = snapshot.Snapshot.CACHED_FLASH
+            else:
+                LOG.info("Reading location data")
+                locations = i.interrogate(meta[1])
+                if icache.store(meta[0], meta[1], locations) is not None:
+                    LOG.info("Cached the interrogation (%s)" % key[:12])
+
+            snapname = create_filename("snapshot", args.path, ext=snapshot.Snapshot.EXT, tstamp=timestamp,
+                                       identifier=file_identifier)
+            LOG.info("Writing location snapshot: %s" % snapname)
+            snapshot.Snapshot.write(snapname, locations, snapflags)
+            meta_out['snapshot'] = os.path.basename(snapname)
 
             LOG.info("Interrogation done (%.2f sec)" % (time.time() - time1))
+            LOG.info("Requests: %(requests)d sent, %(retries)d retried, %(failed)d failed" % i.stats)
+            LOG.info("RX: %s" % rx.format_stats(client.stats()))
 
-            rxThread.stop()
-            rxThread.join()
+            client.close()
 
             LOG.info("Writing meta file")
             metafile.write(json.dumps(meta_out, sort_keys=True, indent=2))
             metafile.close()
 
             # logging
-            ser.timeout = 0.02
-            rxThread.buffer_size = 8196
-            sizelimit = convert_sizelimit(args.size) if args.size is not None else 128000000
+            ser.timeout = READ_TIMEOUT
             LOG.info("Setting logfile size to: %d bytes" % sizelimit)
+            logname = create_filename(args.prefix, args.path, tstamp=timestamp, identifier=file_identifier)
+            recorder = LogRecorder(ser, logname, sizelimit, args.codec, args.level)
+            LOG.info("Opening logfile: %s" % recorder.logfile.filepath)
 
             LOG.info("Start logging... (Ctrl+C to quit)")
-            spinner = busy_icon()
-            logcounter = 1
-
-            msg = None
-            while True:
-                buf = ser.read(128)
-
-                if os.path.getsize(logname) >= sizelimit:
-                    logfile.close()
-                    executor.submit(compress_file, logfile.name)
-                    logname = "%s.%d" % (basename, logcounter)
-                    logfile = open(logname, 'w')
-                    sys.stdout.flush()
-                    sys.stdout.write('\b')
-                    LOG.info("=> %s" % logname)
-                    logcounter += 1
-
-                logfile.write(buf)
-                sys.stdout.write(spinner.next())
-                sys.stdout.flush()
-                sys.stdout.write('\b')
+            recorder.run()
         except KeyboardInterrupt:
-            LOG.info("Logging stopped")
-            ser.close()
-            logfile.close()
-            LOG.info("Compressing logfile")
-            compress_file(logfile.name)
+            stopped = True
             exit(0)
         except NotImplementedError, ex:
             LOG.error(ex.message)
@@ -194,5 +354,21 @@ def execute():
             LOG.error("IO: " + ex.message)
         except OSError, ex:
             LOG.error("OS: " + ex.message)
+        finally:
+            # Every way out of the session finishes the compressed logfile
+            logname = None
+            if recorder is not None:
+                try:
+                    logname = recorder.close()
+                except IOError, ex:
+                    LOG.error("IO: %s" % ex)
+            if client is not None:
+                client.close()
+            if ser is not None:
+                ser.close()
+            if stopped:
+                LOG.info("Logging stopped")
+            if logname is not None:
+                LOG.info("Logfile: %s" % logname)
     else:
         parser.print_usage()
@@ -9,42 +9,52 @@ __author__ = 'ari'
 import logging
 import argparse
 import serial
-import Queue
-import time
 import struct
 import re
-import binascii
+import os
 import sys
+import time
+import concurrent.futures as futures
 from serial.serialutil import SerialException
-from fuct import log, rx, protocol, __version__, __git__
+from fuct import log, rx, protocol, eventloop, stats, client as fuct_client, __version__, __git__
 
 LOG = log.fuct_logger('fuctlog')
 ANGLE_FACTOR = 50.00
 ANGLE_MAX = 719.98
-QUEUE_SIZE_LOG = 50
-
-
-def get_timing_values(rows):
-    values = []
-    for row in rows:
-        values.append(struct.unpack('>H', buffer(row[54:56])))
-    return to_angle(min(values)[0]), to_angle(max(values)[0])
-
-
-def write_trigger_message(offset, flash=False):
-    return protocol.Protocol.create_packet(
+OFFSET_MAX = int(round(ANGLE_MAX * ANGLE_FACTOR))  # Raw value of ANGLE_MAX
+QUEUE_SIZE_LOG = 50  # Log packets the advance readings are taken from
+ADVANCE_OFFSET = 54
+LIVE_INTERVAL = 0.25
+LOG_TIMEOUT = 2.0  # Seconds without log packets before a warning
+WRITE_TIMEOUT = 2.0
+QUIET_TIME = 2 * WRITE_TIMEOUT  # No requests with the response ID of a timed out request, its late answer is dropped
+PROMPT = '>>> '
+
+
+def format_advance(advance):
+    """
+    Readout of the rolling advance statistics, the jitter is in raw units (0.02 deg)
+    """
+    return "Advance: %.2f deg (min %.2f, max %.2f, sd %.2f, %d rows), jitter: %s" % \
+           (to_angle(advance.mean), to_angle(advance.min), to_angle(advance.max), to_angle(advance.stddev),
+            advance.count, ' '.join('%+d:%d' % bin for bin in advance.jitter()) or '-')
+
+
+def write_trigger(client, offset, flash=False):
+    client.call(
         protocol.Protocol.FE_CMD_RAM_WRITE if flash is False else protocol.Protocol.FE_CMD_FLASH_WRITE,
         location=protocol.Protocol.FE_LOCATION_TRIGGER,
-        data=offset,
+        data=struct.pack('>H', offset),
         size=2,
         use_length=True)
 
 
-def read_trigger_message(flash=False):
-    return protocol.Protocol.create_packet(
+def read_trigger(client, flash=False):
+    data = client.call(
         protocol.Protocol.FE_CMD_RAM_READ if flash is False else protocol.Protocol.FE_CMD_FLASH_READ,
         location=protocol.Protocol.FE_LOCATION_TRIGGER,
         size=2)
+    return struct.unpack('>H', buffer(data))[0]
 
 
 def to_angle(value):
@@ -62,6 +72,293 @@ def check_offset_arg(value):
     return val
 
 
+class TriggerTool(object):
+    """
+    Event handlers of fucttrigger. Keyboard input, log packets and write acknowledgements are handled by the event
+    loop as soon as they arrive, so an offset change is sent at once and its acknowledgement is shown without waiting
+    for the next keypress. The time from the keypress to the acknowledgement of the write is measured.
+
+    With ram the offset changes are written into RAM only and flash is written (and read back to verify it) on the
+    commit command or on exit. Only one offset write is in flight, the changes made while it is on the way are
+    coalesced into a single write of the latest value.
+
+    A late acknowledgement to a timed out request would complete the next request with the same response ID, so
+    after a timeout nothing with that ID is sent for QUIET_TIME seconds and the offset write is deferred meanwhile.
+
+    Every log packet updates the rolling advance statistics (constant time), the readout is always current and can
+    be refreshed continuously with the live mode.
+    """
+
+    def __init__(self, loop, client, offset, flash_offset=None, ram=False):
+        self.loop = loop
+        self.client = client
+        self.offset = offset
+        self.flash_offset = flash_offset if flash_offset is not None else offset
+        self.ram = ram
+        self.advance = stats.RollingStats(QUEUE_SIZE_LOG)
+        self.live = None  # Timer of the live readout
+        self.latencies = []
+        self.steady = True
+        self.done = False
+        self._received = 0
+        self._rx_errors = 0
+        self._input = ''
+        self._writing = None  # Future of the offset write in flight
+        self._deferred = None  # Timer of the offset write waiting for a quiet period to end
+        self._quiet = {}  # Response ID -> time until which no request is sent with it
+        self._pressed = None  # Time of the keypress the offset is from
+
+    def start(self):
+        self.loop.add_reader(sys.stdin, self.on_input)
+        self.loop.call_later(LOG_TIMEOUT, self.check)
+        self.prompt()
+
+    def prompt(self):
+        sys.stdout.write(PROMPT)
+        sys.stdout.flush()
+
+    def on_log(self, packet):
+        advance = self.advance
+        with packet:
+            advance.add(struct.unpack_from('>H', packet.data, ADVANCE_OFFSET)[0])
+        self._received += 1
+        if advance.count < advance.size:
+            return  # Not judged before the window is full again
+        if self.steady and advance.min != advance.max and self.live is None:
+            LOG.warning("Ignition advance is not steady, travels between %.2f <-> %.2f deg" %
+                        (to_angle(advance.min), to_angle(advance.max)))
+        self.steady = advance.min == advance.max
+
+    def on_input(self):
+        pressed = time.time()
+        data = os.read(sys.stdin.fileno(), 1024)
+        if not data:
+            self.done = True
+            self.loop.stop()  # EOF
+            return
+        self._input += data
+        while '\n' in self._input:
+            line, self._input = self._input.split('\n', 1)
+            self.command(line.strip(), pressed)
+        if not self.done:
+            self.prompt()
+
+    def command(self, line, pressed):
+        offset_new = self.offset
+        if line == 'a':
+            offset_new += ANGLE_FACTOR
+        elif line == 'z':
+            offset_new -= ANGLE_FACTOR
+        elif line == 's':
+            offset_new += ANGLE_FACTOR * 10
+        elif line == 'x':
+            offset_new -= ANGLE_FACTOR * 10
+        elif line == 'd':
+            offset_new += ANGLE_FACTOR / 10
+        elif line == 'c':
+            offset_new -= ANGLE_FACTOR / 10
+        elif re.match("^(?=.*\d)\d{1,3}(?:\.\d{1,2})?$", line) is not None:
+            v = float(line)
+            if 0 <= v <= ANGLE_MAX:
+                offset_new = to_raw_angle(v)
+            else:
+                LOG.error("Invalid value, use 0-%.2f" % ANGLE_MAX)
+        elif line == '':
+            if self.advance.count:
+                LOG.info("%s, Trigger offset: %.2f" % (format_advance(self.advance), to_angle(self.offset)))
+            LOG.info("RX: %s" % rx.format_stats(self.client.stats()))
+        elif line == 'l':
+            if self.live is None:
+                self.live = self.loop.call_later(0, self.refresh)
+            else:
+                self.live.cancel()
+                self.live = None
+                sys.stdout.write('\n')
+        elif line == 'w' and self.ram:
+            self.commit(pressed)
+        elif line == 'exit' or line == 'quit':
+            self.done = True
+            self.loop.stop()
+            return
+
+        if not 0 <= offset_new <= OFFSET_MAX:
+            offset_new = min(max(offset_new, 0), OFFSET_MAX)
+            LOG.warning("Trigger offset limited to 0-%.2f deg" % ANGLE_MAX)
+        if offset_new != self.offset:
+            self.offset = offset_new
+            self._pressed = pressed
+            LOG.debug("Raw offset value: %d" % offset_new)
+            if self._writing is None and self._deferred is None:
+                self.write()
+
+    def write(self):
+        """
+        Sends the current offset, into RAM or flash
+        """
+        payload = protocol.Protocol.FE_CMD_RAM_WRITE if self.ram else protocol.Protocol.FE_CMD_FLASH_WRITE
+        wait = self.__quiet(payload)
+        if wait > 0:
+            self._deferred = self.loop.call_later(wait, self.__write_deferred)
+            return
+        offset, pressed = self.offset, self._pressed
+        future = self._writing = self.__request(payload, offset)
+        timer = self.loop.call_later(WRITE_TIMEOUT, self.__timeout, future, "offset write")
+        future.add_done_callback(lambda f: self.__write_done(f, offset, pressed, timer))
+
+    def commit(self, pressed):
+        """
+        Writes the current offset into flash and reads it back
+        """
+        wait = self.__quiet(protocol.Protocol.FE_CMD_FLASH_WRITE)
+        if wait > 0:
+            self.loop.call_later(wait, self.commit, pressed)
+            return
+        offset = self.offset
+        future = self.__request(protocol.Protocol.FE_CMD_FLASH_WRITE, offset)
+        timer = self.loop.call_later(WRITE_TIMEOUT, self.__timeout, future, "flash write")
+        future.add_done_callback(lambda f: self.__committed(f, offset, pressed, timer))
+
+    def finish(self):
+        """
+        Waits for the offset write in flight and commits the offset into flash (RAM mode), after the loop has stopped
+        """
+        if self.live is not None:
+            self.live.cancel()
+        if self._deferred is not None:
+            self._deferred.cancel()
+            self._deferred = None
+            if not self.ram:
+                self.__settle(protocol.Protocol.FE_CMD_FLASH_WRITE)
+                write_trigger(self.client, self.offset, flash=True)
+                self.flash_offset = self.offset
+                LOG.info("Trigger offset set to: %.2f deg" % to_angle(self.offset))
+        if self._writing is not None:
+            try:
+                self.loop.run_until(self._writing, WRITE_TIMEOUT)
+            except futures.TimeoutError:
+                self.__timeout(self._writing, "offset write")
+            except (futures.CancelledError, ValueError):
+                pass
+        if self.ram and self.offset != self.flash_offset:
+            LOG.info("Committing trigger offset %.2f deg to flash" % to_angle(self.offset))
+            self.__settle(protocol.Protocol.FE_CMD_FLASH_WRITE)
+            write_trigger(self.client, self.offset, flash=True)
+            self.__settle(protocol.Protocol.FE_CMD_FLASH_READ)
+            if read_trigger(self.client, flash=True) != self.offset:
+                raise ValueError("Flash read-back does not match the trigger offset, check the device!")
+            self.flash_offset = self.offset
+            LOG.info("Trigger offset in flash verified: %.2f deg" % to_angle(self.offset))
+
+    def refresh(self):
+        """
+        Rewrites the live readout line, runs every LIVE_INTERVAL seconds in the live mode
+        """
+        if self.advance.count:
+            sys.stdout.write('\r%s, offset %.2f  %s' % (format_advance(self.advance), to_angle(self.offset), PROMPT))
+            sys.stdout.flush()
+        self.live = self.loop.call_later(LIVE_INTERVAL, self.refresh)
+
+    def check(self):
+        """
+        Warns about a stopped log stream and corrupted frames, runs every LOG_TIMEOUT seconds
+        """
+        if not self._received:
+            LOG.warning("No log packets received, is the device streaming?")
+        self._received = 0
+        rx_stats = self.client.stats()
+        if rx_stats['bad_checksum'] + rx_stats['length_mismatch'] > self._rx_errors:
+            self._rx_errors = rx_stats['bad_checksum'] + rx_stats['length_mismatch']
+            LOG.warning("Corrupted frames received, RX: %s" % rx.format_stats(rx_stats))
+        self.loop.call_later(LOG_TIMEOUT, self.check)
+
+    def report(self):
+        if self.latencies:
+            LOG.info("Write latency (keypress -> %s ack): %d writes, min %.0f ms, mean %.0f ms, max %.0f ms" %
+                     ('RAM' if self.ram else 'flash', len(self.latencies), min(self.latencies) * 1000,
+                      sum(self.latencies) / len(self.latencies) * 1000, max(self.latencies) * 1000))
+
+    # -----
+
+    def __request(self, payload, offset):
+        return self.client.request(payload, location=protocol.Protocol.FE_LOCATION_TRIGGER, size=2,
+                                   data=struct.pack('>H', offset), use_length=True)
+
+    def __write_done(self, future, offset, pressed, timer):
+        timer.cancel()
+        self._writing = None
+        if future.cancelled() or future.exception() is not None:
+            if not future.cancelled():
+                LOG.error("Writing the trigger offset failed: %s" % future.exception())
+        else:
+            latency = time.time() - pressed
+            self.latencies.append(latency)
+            self.advance.reset()  # Readings of the new offset only
+            if not self.ram:
+                self.flash_offset = offset
+            LOG.info("Trigger offset set to: %.2f deg%s (%.0f ms)" %
+                     (to_angle(offset), ' (RAM)' if self.ram else '', latency * 1000))
+        if self.offset != offset and not self.done:
+            self.write()  # The changes made meanwhile
+
+    def __committed(self, future, offset, pressed, timer):
+        timer.cancel()
+        if future.cancelled() or future.exception() is not None:
+            if not future.cancelled():
+                LOG.error("Writing the trigger offset into flash failed: %s" % future.exception())
+            return
+        self.__read_back(offset, pressed)
+
+    def __read_back(self, offset, pressed):
+        wait = self.__quiet(protocol.Protocol.FE_CMD_FLASH_READ)
+        if wait > 0:
+            self.loop.call_later(wait, self.__read_back, offset, pressed)
+            return
+        read = self.client.request(protocol.Protocol.FE_CMD_FLASH_READ, location=protocol.Protocol.FE_LOCATION_TRIGGER,
+                                   size=2)
+        timer = self.loop.call_later(WRITE_TIMEOUT, self.__timeout, read, "flash read-back")
+        read.add_done_callback(lambda f: self.__verified(f, offset, pressed, timer))
+
+    def __verified(self, future, offset, pressed, timer):
+        timer.cancel()
+        if future.cancelled() or future.exception() is not None:
+            return
+        data = future.result()
+        if data is None or len(data) != 2 or struct.unpack('>H', buffer(data))[0] != offset:
+            LOG.error("Flash read-back does not match the trigger offset %.2f deg, commit again!" % to_angle(offset))
+            return
+        self.flash_offset = offset
+        LOG.info("Trigger offset %.2f deg committed to flash and verified (%.0f ms)" %
+                 (to_angle(offset), (time.time() - pressed) * 1000))
+
+    def __write_deferred(self):
+        self._deferred = None
+        if not self.done:
+            self.write()
+
+    def __quiet(self, payload):
+        """
+        Seconds until a request of payload can be sent after a timed out one
+        """
+        return max(self._quiet.get(payload + 1, 0) - time.time(), 0)
+
+    def __settle(self, payload):
+        """
+        Runs the loop until a request of payload can be sent, a late answer arriving meanwhile is dropped
+        """
+        wait = self.__quiet(payload)
+        if wait > 0:
+            try:
+                self.loop.run_until(futures.Future(), wait)
+            except futures.TimeoutError:
+                pass
+
+    def __timeout(self, future, what):
+        if not future.done():
+            self.client.cancel(future)
+            self._quiet[future.response_id] = time.time() + QUIET_TIME
+            LOG.error("Device did not answer the trigger %s" % what)
+
+
 def execute():
     parser = argparse.ArgumentParser(
         prog='fucttrigger',
@@ -70,13 +367,15 @@ def execute():
     'fucttrigger' is a tool to adjust the decoder trigger offset on a fresh FreeEMS install. You need a timinglight
     or a similar tool to check the correct alignment. Also make sure you use flat timing tables (ex. 10 deg BTDC) so
     you get a good consistent reading. An initial offset can be used to load it to the device when the application
-    is started.
+    is started. With --ram the adjustments go into RAM and flash is written on commit ('w') or on exit.
 
     Example: fucttrigger -o 90 /dev/ttyUSB0''' % (__version__, __git__),
         formatter_class=argparse.RawTextHelpFormatter,)
     parser.add_argument('-v', '--version', action='store_true', help='show program version')
     parser.add_argument('-d', '--debug', action='store_true', help='show debug information')
     parser.add_argument('-o', '--offset', type=check_offset_arg, nargs='?', help='initial trigger offset in degrees ATDC (0-719.98)')
+    parser.add_argument('-r', '--ram', action='store_true',
+                        help='adjust the offset in RAM, write it into flash on commit or exit')
     parser.add_argument('serial', nargs='?', help='serialport device (eg. /dev/xxx, COM1)')
 
     args = parser.parse_args()
@@ -85,115 +384,71 @@ def execute():
         print "fucttrigger %s (Git: %s)" % (__version__, __git__)
     elif args.serial is not None:
         LOG.info("FUCT - fucttrigger %s (Git: %s)" % (__version__, __git__))
-        rxThread = None
+        client = tool = None
         try:
             if args.debug:
                 LOG.setLevel(logging.DEBUG)
+            if os.name != 'posix':
+                raise NotImplementedError("fucttrigger needs a POSIX system (select() on the terminal)")
 
             LOG.info("Opening port %s" % args.serial)
             ser = serial.Serial(args.serial, 115200, bytesize=8, parity=serial.PARITY_ODD, stopbits=1)
             LOG.debug(ser)
 
-            queue_in = Queue.Queue(0)
-            queue_out = Queue.Queue(0)
-            queue_log = Queue.Queue(QUEUE_SIZE_LOG)
-
-            ser.timeout = 0.02
-            rxThread = rx.RxThread(ser, queue_in, queue_log)
-            rxThread.buffer_size = 1024
-            rxThread.logging = True
-            rxThread.start()
-
-            init = True
-            offset_value = 0  # 1 unit = 0.02 deg
-            queue_out.put(protocol.Protocol.create_packet(protocol.Protocol.FE_CMD_DECODER))
-            updating = False
-
-            while True:
-                try:
-                    time.sleep(0.2)
-                    packet = queue_out.get(False)
-                    LOG.debug("--> %s" % binascii.hexlify(packet[1:-2]))
-                    ser.write(packet)
-                    ser.flush()
-                except Queue.Empty:
-                    pass
-
-                try:
-                    msg = queue_in.get(False)
-                    LOG.debug("<-- %s" % binascii.hexlify(msg))
-                    data = protocol.Protocol.decode_packet(msg)
-
-                    if init:
-                        if data[0] == protocol.Protocol.FE_CMD_DECODER + 1:
-                            LOG.info("Decoder: %s" % data[1])
-                            queue_out.put(read_trigger_message(flash=True))
-                        if data[0] == protocol.Protocol.FE_CMD_FLASH_READ + 1:
-                            offset_value = struct.unpack('>H', buffer(data[1]))[0]
-                            LOG.info("Current trigger offset in flash: %.2f deg" % to_angle(offset_value))
-                            if args.offset is not None:
-                                offset_value = to_raw_angle(args.offset)
-                                LOG.info("Initial trigger offset: %.2f deg" % args.offset)
-                                queue_out.put(write_trigger_message(struct.pack('>H', offset_value), flash=True))
-                            LOG.info("Type a new value (0-%.2f) or use predefined commands" % ANGLE_MAX)
-                            LOG.info("Commands: 'a' => +1, 'z' => -1, 's' => +10, 'x' => -10, 'd' => +0.1, 'c' => -0.1")
-                            LOG.info("          'quit' or 'exit' => Exit program")
-                            init = False
-                    else:
-                        if data[0] == protocol.Protocol.FE_CMD_FLASH_WRITE + 1:
-                            LOG.info("Trigger offset set to: %.2f deg" % to_angle(offset_value))
-                            updating = False
-
-                except Queue.Empty:
-                    pass
-
-                if not init and not updating:
-                    log_rows = []
-                    for x in range(0, QUEUE_SIZE_LOG):
-                        log_rows.append(queue_log.get(x))
-                    ign = get_timing_values(log_rows)
-                    if ign[0] != ign[1]:
-                        LOG.warning("Ignition advance is not steady, travels between %.2f <-> %.2f deg" % ign)
-
-                    line = raw_input('>>> ')
-                    offset_new = offset_value
-                    if line == 'a':
-                        offset_new += ANGLE_FACTOR
-                    elif line == 'z':
-                        offset_new -= ANGLE_FACTOR
-                    elif line == 's':
-                        offset_new += ANGLE_FACTOR * 10
-                    elif line == 'x':
-                        offset_new -= ANGLE_FACTOR * 10
-                    elif line == 'd':
-                        offset_new += ANGLE_FACTOR / 10
-                    elif line == 'c':
-                        offset_new -= ANGLE_FACTOR / 10
-                    elif re.match("^(?=.*\d)\d{1,3}(?:\.\d{1,2})?$", line) is not None:
-                        v = float(line)
-                        if v >= 0 or v <= ANGLE_MAX:
-                            offset_new = to_raw_angle(v)
-                        else:
-                            LOG.error("Invalid value, use 0-%.2f" % ANGLE_MAX)
-                    elif line == '':
-                        LOG.info("Advance: %.2f deg, Trigger offset: %.2f" % (ign[0], to_angle(offset_value)))
-                    elif line == 'exit' or line == 'quit':
-                        rxThread.stop()
-                        LOG.info("Exiting...")
-                        sys.exit(0)
-
-                    if offset_new != offset_value:
-                        offset_value = offset_new
-                        LOG.debug("Raw offset value: %d" % offset_new)
-                        queue_out.put(write_trigger_message(struct.pack('>H', offset_value), flash=True))
-                        updating = True
+            ser.timeout = 0.1
+            loop = eventloop.EventLoop()
+            client = fuct_client.Client(ser, on_log=lambda packet: tool.on_log(packet) if tool else packet.release())
+            client.attach(loop, logging=True)
+
+            LOG.info("Decoder: %s" % client.call(protocol.Protocol.FE_CMD_DECODER))
+            flash_value = offset_value = read_trigger(client, flash=True)  # 1 unit = 0.02 deg
+            LOG.info("Current trigger offset in flash: %.2f deg" % to_angle(offset_value))
+            if args.ram:
+                offset_value = read_trigger(client)
+                if offset_value != flash_value:
+                    LOG.warning("Trigger offset in RAM differs from flash: %.2f deg" % to_angle(offset_value))
+            if args.offset is not None:
+                flash_value = offset_value = to_raw_angle(args.offset)
+                LOG.info("Initial trigger offset: %.2f deg" % args.offset)
+                write_trigger(client, offset_value, flash=True)
+                if args.ram:
+                    write_trigger(client, offset_value)
+                LOG.info("Trigger offset set to: %.2f deg" % to_angle(offset_value))
+            LOG.info("Type a new value (0-%.2f) or use predefined commands" % ANGLE_MAX)
+            LOG.info("Commands: 'a' => +1, 'z' => -1, 's' => +10, 'x' => -10, 'd' => +0.1, 'c' => -0.1")
+            LOG.info("          '' => Show advance, 'l' => Toggle live advance readout")
+            if args.ram:
+                LOG.info("          'w' => Commit the offset into flash (also done on exit)")
+            LOG.info("          'quit' or 'exit' => Exit program")
+
+            tool = TriggerTool(loop, client, offset_value, flash_value, ram=args.ram)
+            tool.start()
+            loop.run()
+
+            tool.report()
+            tool.finish()
+            client.close()
+            LOG.info("Exiting...")
 
         except KeyboardInterrupt:
-            rxThread.stop()
+            if tool is not None:
+                tool.report()
+                try:
+                    tool.finish()
+                except (futures.TimeoutError, ValueError), ex:
+                    LOG.error("Committing the trigger offset failed: %s" % (ex.message or "no response"))
+            if client is not None:
+                client.close()
             LOG.info("Exiting...")
+        except futures.TimeoutError:
+            if client is not None:
+                client.close()
+            LOG.error("Device did not respond in time")
         except NotImplementedError, ex:
             LOG.error(ex.message)
         except (AttributeError, ValueError), ex:
+            if client is not None:
+                client.close()
             LOG.error(ex.message)
         except SerialException, ex:
             LOG.error("Serial: " + ex.message)
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+
+__author__ = 'ari'
+
+import os
+import json
+import struct
+import hashlib
+import binascii
+import logging
+import tempfile
+from srecord import SRecord, STYPES
+from pages import FlashImage
+from validator import Firmware
+from interrogator import Location, LocationInfo
+
+LOG = logging.getLogger('fuctlog')
+
+
+class FirmwareCache(object):
+    """
+    Content addressed on-disk cache of validated firmware images, keyed by the SHA-256 of the S19 file.
+
+    Every entry is a single file that is read sequentially straight into the page buffers:
+      header   magic, version, page count, image size, record count, S0 address and data length, S8/S9 type and
+               address, length and SHA-256 of the rest of the entry
+      S0 data
+      index    page number and file offset for every page
+      pages    16k page data, 16k coverage mask and 64 byte dirty block map for every page
+
+    A truncated or corrupted entry (eg. a crash in the middle of a write) fails the length or digest check on load
+    and is dropped like a cache miss.
+
+    The modification time of an entry is its last use, entries are evicted in LRU order when the cache grows over
+    max_size bytes.
+    """
+    MAGIC = 'FUCTIMG'
+    VERSION = 2
+    HEADER = struct.Struct('>7sBHIIIH2sII32s')
+    INDEX = struct.Struct('>BI')
+    EXT = '.img'
+    MAX_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path=None, max_size=MAX_SIZE):
+        self.path = path if path is not None else os.path.join(os.path.expanduser('~'), '.fuct', 'cache')
+        self.max_size = max_size
+
+    @staticmethod
+    def key(filepath):
+        sha = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + self.EXT)
+
+    def load(self, key):
+        path = self.entry_path(key)
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                firmware = self.__unpack(f, os.fstat(f.fileno()).st_size)
+        except (IOError, ValueError, struct.error), ex:
+            LOG.warning("Dropping unreadable cache entry %s (%s)" % (key[:12], ex))
+            self.invalidate(key)
+            return None
+
+        os.utime(path, None)  # Mark as most recently used
+        return firmware
+
+    def store(self, key, firmware):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            self.__pack(f, firmware)
+        os.rename(tmpname, self.entry_path(key))
+        self.evict()
+
+    def invalidate(self, key=None):
+        """
+        Removes a single entry or the whole cache if no key is given. Returns the amount of entries removed.
+        """
+        keys = [key] if key is not None else [name[:-len(self.EXT)] for name, _, _ in self.entries()]
+        removed = 0
+        for k in keys:
+            path = self.entry_path(k)
+            if os.path.isfile(path):
+                os.remove(path)
+                removed += 1
+        return removed
+
+    def entries(self):
+        """
+        Returns (name, size, last use) of the cache entries, least recently used first
+        """
+        if not os.path.isdir(self.path):
+            return []
+
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(self.EXT):
+                st = os.stat(os.path.join(self.path, name))
+                entries.append((name, st.st_size, st.st_mtime))
+        return sorted(entries, key=lambda e: e[2])
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for name, size, _ in entries:
+            if total <= self.max_size:
+                break
+            LOG.debug("Evicting cached firmware %s" % name)
+            os.remove(os.path.join(self.path, name))
+            total -= size
+
+    # -----
+
+    def __pack(self, f, firmware):
+        image = firmware.image
+        header = firmware.header
+        header_data = header.data if header is not None else bytearray()
+        term = firmware.termination
+        image_pages = image.pages()
+
+        offset = self.HEADER.size + len(header_data) + self.INDEX.size * len(image_pages)
+        index = []
+        for page in image_pages:
+            index.append(self.INDEX.pack(page, offset))
+            offset += image.PAGE_SIZE * 2 + image.BLOCKS
+        body = [header_data] + index
+        for page in image_pages:
+            body.extend((image.data[page], image.mask[page], image.dirty[page]))
+
+        sha = hashlib.sha256()
+        for data in body:
+            sha.update(data)
+        f.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(image_pages), image.size, firmware.records,
+                                 header.address if header is not None else 0, len(header_data),
+                                 term.stype[0] if term is not None else '', term.address if term is not None else 0,
+                                 offset - self.HEADER.size, sha.digest()))
+        for data in body:
+            f.write(data)
+
+    def __unpack(self, f, filesize):
+        magic, version, page_count, size, records, header_addr, header_len, term_type, term_addr, length, digest = \
+            self.HEADER.unpack(f.read(self.HEADER.size))
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError('unknown format')
+        if filesize - self.HEADER.size != length:
+            raise ValueError('truncated entry')
+
+        sha = hashlib.sha256()
+
+        def read(n):
+            data = f.read(n)
+            sha.update(data)
+            return data
+
+        def read_into(n):
+            data = bytearray(n)
+            if f.readinto(data) != n:
+                raise ValueError('truncated entry')
+            sha.update(data)
+            return data
+
+        header = SRecord(STYPES['S0'], header_addr, read_into(header_len)) if header_len else None
+        index = read(self.INDEX.size * page_count)
+
+        image = FlashImage()
+        offset = self.HEADER.size + header_len + len(index)
+        for i in xrange(page_count):
+            page, pos = self.INDEX.unpack_from(index, i * self.INDEX.size)
+            if pos != offset:
+                raise ValueError('bad page offset')
+            image.data[page] = read_into(image.PAGE_SIZE)
+            image.mask[page] = read_into(image.PAGE_SIZE)
+            image.dirty[page] = read_into(image.BLOCKS)
+            offset += image.PAGE_SIZE * 2 + image.BLOCKS
+        image.size = size
+
+        if sha.digest() != digest:
+            raise ValueError('digest mismatch')
+        termination = SRecord(STYPES[term_type], term_addr) if term_type in STYPES else None
+        return Firmware(header, termination, records, image)
+
+
+class InterrogationCache(object):
+    """
+    On-disk cache of device interrogations, keyed by the build identity (firmware, build date and compiler strings)
+    of the firmware. An entry holds the location ID list, the location table and the flash contents, RAM is not
+    cached as it changes while tuning.
+
+    Entries are never expired, they are replaced with refresh or removed with invalidate().
+    """
+    IDENTITY = ('firmware', 'build_date', 'compiler')
+    VERSION = 1
+    EXT = '.json'
+
+    def __init__(self, path=None):
+        self.path = path if path is not None else os.path.join(os.path.expanduser('~'), '.fuct', 'interrogation')
+
+    @classmethod
+    def key(cls, meta):
+        return hashlib.sha256('\0'.join(meta.get(name, '') for name in cls.IDENTITY)).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + self.EXT)
+
+    def load(self, meta, location_ids):
+        """
+        Returns the cached dict of location ID -> Location (without RAM contents), or None if the build is not
+        cached or the device reports different location IDs
+        """
+        key = self.key(meta)
+        path = self.entry_path(key)
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            if entry['version'] != self.VERSION:
+                raise ValueError('unknown format')
+            if [entry['identity'].get(name) for name in self.IDENTITY] != [meta.get(name) for name in self.IDENTITY]:
+                raise ValueError('identity mismatch')
+            if entry['location_ids'] != list(location_ids):
+                LOG.info("Location IDs differ from the cached interrogation (%s)" % key[:12])
+                return None
+            locations = {}
+            for lid, info, flash in entry['locations']:
+                locations[lid] = Location(LocationInfo(*info), None,
+                                          bytearray(binascii.unhexlify(flash)) if flash is not None else None)
+        except (IOError, ValueError, KeyError, TypeError), ex:
+            LOG.warning("Dropping unreadable interrogation cache entry %s (%s)" % (key[:12], ex))
+            self.invalidate(key)
+            return None
+        return locations
+
+    def store(self, meta, location_ids, locations):
+        """
+        Stores a complete interrogation and returns its key. Returns None (and stores nothing) if a location info or
+        flash read failed.
+        """
+        if any(lid not in locations or (locations[lid].info.flash_page > 0 and locations[lid].flash is None)
+               for lid in location_ids):
+            return None
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        entry = {
+            'version': self.VERSION,
+            'identity': dict((name, meta.get(name)) for name in self.IDENTITY),
+            'location_ids': list(location_ids),
+            'locations': [[lid, list(loc.info), binascii.hexlify(loc.flash) if loc.flash is not None else None]
+                          for lid, loc in sorted(locations.iteritems())]
+        }
+        key = self.key(meta)
+        fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmpname, self.entry_path(key))
+        return key
+
+    def invalidate(self, key=None):
+        """
+        Removes a single entry or the whole cache if no key is given. Returns the amount of entries removed.
+        """
+        if key is not None:
+            names = [key + self.EXT]
+        elif os.path.isdir(self.path):
+            names = [name for name in os.listdir(self.path) if name.endswith(self.EXT)]
+        else:
+            names = []
+        removed = 0
+        for name in names:
+            path = os.path.join(self.path, name)
+            if os.path.isfile(path):
+                os.remove(path)
+                removed += 1
+        return removed
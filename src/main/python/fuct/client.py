@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+
+__author__ = 'ari'
+
+import Queue
+import logging
+import binascii
+import threading
+import collections
+import concurrent.futures as futures
+import rx
+from protocol import Protocol
+
+LOG = logging.getLogger('fuctlog')
+DEFAULT_TIMEOUT = 2.0
+QUEUE_SIZE_LOG = 50
+
+
+class Client(object):
+    """
+    Request/response transport for the FreeEMS serial protocol. request() sends a packet and returns a Future that
+    the RX thread completes when the response (payload ID + 1) arrives, responses with the same ID complete the
+    requests in the order they were sent. Log packets (0x191) are streamed separately through log_packets().
+
+    Nothing is polled, callers block on the futures or on the log queue until the RX thread hands them data. With
+    attach() the port is read by an event loop instead of the RX thread, the futures complete (and log packets are
+    passed to on_log) in the loop thread and call() runs the loop while it waits.
+    """
+    NAK = 0x02  # Header flag of an error response
+
+    def __init__(self, ser, log_queue_size=QUEUE_SIZE_LOG, on_log=None):
+        self.ser = ser
+        self.queue_log = Queue.Queue(log_queue_size)
+        self.rx = rx.RxThread(ser, None, self.queue_log, on_response=self.__on_response, on_log=on_log)
+        self.loop = None
+        self._pending = collections.defaultdict(collections.deque)  # Response payload ID -> futures
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def start(self, logging=False):
+        self.rx.logging = logging
+        self.rx.start()
+        return self
+
+    def attach(self, loop, logging=False):
+        """
+        Reads the port from the event loop instead of starting the RX thread
+        """
+        self.rx.logging = logging
+        self.loop = loop
+        loop.add_reader(self.ser, self.__on_readable)
+        return self
+
+    def close(self):
+        """
+        Stops the RX thread (or detaches from the event loop) and fails the requests still waiting for a response
+        """
+        self._closed = True
+        if self.loop is not None:
+            self.loop.remove_reader(self.ser)
+        self.rx.stop()
+        if self.rx.is_alive():
+            self.rx.join()
+        with self._lock:
+            pending = [f for waiting in self._pending.itervalues() for f in waiting]
+            self._pending.clear()
+        for future in pending:
+            future.cancel()
+        while not self.queue_log.empty():
+            packet = self.queue_log.get_nowait()
+            if packet is not None:
+                packet.release()
+        self.queue_log.put(None)  # Ends log_packets()
+
+    def set_logging(self, enabled):
+        self.rx.logging = enabled
+
+    def stats(self):
+        return self.rx.stats()
+
+    def request(self, payload, location=None, size=None, data=None, use_length=False):
+        """
+        Sends a request and returns a Future of the response data (bytearray or None). An error response fails the
+        future with ValueError.
+        """
+        return self.send(Protocol.create_packet(payload, location, size, data, use_length), payload + 1)
+
+    def send(self, packet, response_id):
+        future = futures.Future()
+        future.response_id = response_id
+        with self._lock:
+            if self._closed:
+                raise IOError('Client is closed')
+            self._pending[response_id].append(future)
+        LOG.debug("--> %s" % binascii.hexlify(packet[1:-2]))
+        try:
+            self.ser.write(packet)
+            self.ser.flush()
+        except Exception:
+            self.cancel(future)
+            raise
+        return future
+
+    def call(self, payload, location=None, size=None, data=None, use_length=False, timeout=DEFAULT_TIMEOUT):
+        """
+        Sends a request and waits for the response data. Raises futures.TimeoutError (and forgets the request) if
+        no response arrives in timeout seconds.
+        """
+        future = self.request(payload, location, size, data, use_length)
+        try:
+            if self.loop is not None:
+                return self.loop.run_until(future, timeout)
+            return future.result(timeout)
+        except futures.TimeoutError:
+            self.cancel(future)
+            raise
+
+    def cancel(self, future):
+        """
+        Forgets a request, a late response to it is dropped
+        """
+        with self._lock:
+            waiting = self._pending.get(future.response_id)
+            if waiting is not None and future in waiting:
+                waiting.remove(future)
+        future.cancel()
+
+    def log_packets(self, timeout=None):
+        """
+        Yields the log packets as PacketViews until the client is closed (or nothing arrives in timeout seconds).
+        Release every view after use.
+        """
+        while True:
+            try:
+                # A blocking get without a timeout would not see Ctrl+C
+                packet = self.queue_log.get(True, timeout if timeout is not None else 1.0)
+            except Queue.Empty:
+                if timeout is not None or self._closed:
+                    return
+                continue
+            if packet is None:
+                return
+            yield packet
+
+    # -----
+
+    def __on_readable(self):
+        self.rx.feed(self.ser.read(self.ser.inWaiting() or 1))
+
+    def __on_response(self, frame):
+        LOG.debug("<-- %s" % binascii.hexlify(frame))
+        payload, data = Protocol.decode_packet(frame)
+        with self._lock:
+            waiting = self._pending.get(payload)
+            future = waiting.popleft() if waiting else None
+        if future is None:
+            LOG.debug("Unexpected response 0x%04x, dropping it" % payload)
+        elif frame[0] & self.NAK:
+            future.set_exception(ValueError('Request 0x%04x failed (error response)' % (payload - 1)))
+        else:
+            future.set_result(data)
@@ -7,9 +7,129 @@
 __author__ = 'ari'
 
 import sys
+import time
+import Queue
+import threading
+
+_local = threading.local()
+_stop = threading.Event()
+
+
+class MultiProgress(object):
+    """
+    Renders the progress of several parallel workers on a single status line, at most every interval seconds
+    """
+
+    def __init__(self, names, bar_length=10, interval=0.2):
+        self.names = names
+        self.bar_length = bar_length
+        self.interval = interval
+        self.progress = dict((name, 0.0) for name in names)
+        self.lock = threading.Lock()
+        self.last_update = 0
+
+    def update(self, name, progress):
+        with self.lock:
+            self.progress[name] = progress
+            now = time.time()
+            if now - self.last_update < self.interval and progress < 1:
+                return
+            self.last_update = now
+            bars = []
+            for n in self.names:
+                hashes = '#' * int(round(self.progress[n] * self.bar_length))
+                bars.append("{0} [{1}] {2:3d}%".format(n, hashes.ljust(self.bar_length), int(round(self.progress[n] * 100))))
+            sys.stdout.write("\r" + " | ".join(bars))
+            sys.stdout.flush()
+
+
+class QueueWriter(threading.Thread):
+    """
+    Output thread fed through a bounded queue. Subclasses implement begin(), handle(item), end() and release(), an
+    IOError/OSError on the thread is raised in the producer on the next put() or on close().
+    """
+
+    def __init__(self, queue_size):
+        super(QueueWriter, self).__init__()
+        self.daemon = True
+        self.queue = Queue.Queue(queue_size)
+        self.error = None
+
+    def put(self, item):
+        if self.error is not None:
+            raise IOError(self.error)
+        self.queue.put(item)
+
+    def close(self, wait=True):
+        """
+        Ends the output after the queued items. Without wait the thread finishes on its own, join() it later.
+        """
+        self.queue.put(None)
+        if wait:
+            self.join()
+            if self.error is not None:
+                raise IOError(self.error)
+
+    def run(self):
+        closed = False  # The None from close() has been taken from the queue
+        try:
+            try:
+                self.begin()
+                for item in iter(self.queue.get, None):
+                    self.handle(item)
+                closed = True
+                self.end()
+            finally:
+                self.release()
+        except (IOError, OSError), ex:
+            self.error = str(ex)
+            while not closed and self.queue.get() is not None:  # Keep the producer from blocking until close()
+                pass
+
+    def begin(self):
+        pass
+
+    def handle(self, item):
+        raise NotImplementedError()
+
+    def end(self):
+        pass
+
+    def release(self):
+        pass
+
+
+def request_stop(stop=True):
+    """
+    Asks the worker threads to stop after their current page, request_stop(False) clears the request
+    """
+    if stop:
+        _stop.set()
+    else:
+        _stop.clear()
+
+
+def check_stop():
+    """
+    Called between pages, raises KeyboardInterrupt in the calling thread once a stop has been requested
+    """
+    if _stop.is_set():
+        raise KeyboardInterrupt()
+
+
+def set_progress_view(view, name):
+    """
+    Routes print_progress calls of the current thread to a MultiProgress view
+    """
+    _local.view = view
+    _local.name = name
 
 
 def print_progress(progress, bar_length=20):
+    view = getattr(_local, 'view', None)
+    if view is not None:
+        view.update(_local.name, progress)
+        return
     hashes = '#' * int(round(progress * bar_length))
     spaces = ' ' * (bar_length - len(hashes))
     sys.stdout.write("\rProgress: [{0}] {1}%".format(hashes + spaces, int(round(progress * 100))))
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+
+__author__ = 'ari'
+
+import os
+import tty
+import time
+import errno
+import random
+import select
+import struct
+import logging
+import threading
+import rx
+from protocol import Protocol
+
+LOG = logging.getLogger('fuctlog')
+
+
+class SMEmulator(threading.Thread):
+    """
+    Emulates the AN2548 serial monitor of a FreeEMS compatible S12XE on a pty (Linux/OS X only). Open the port
+    name in .port with pyserial like a real device.
+
+    byte_us is the wire time of one byte in both directions, erase_ms and erase_all_ms the time an erase takes before
+    the prompt is sent. drop_rate and corrupt_rate are the probabilities of a response being lost or having one byte
+    flipped, stall_ms adds a random delay of up to that much to every response.
+    """
+
+    # Command -> argument byte count, write block has a variable length payload after the length byte
+    ARGS = {
+        0x0D: 0, 0xA1: 2, 0xA2: 3, 0xA3: 2, 0xA4: 4, 0xA7: 3, 0xA8: 3,
+        0xB1: 0, 0xB2: 0, 0xB3: 0, 0xB4: 0, 0xB6: 0, 0xB7: 0, 0xB8: 0, 0xB9: 0
+    }
+    OK = b'\xE0\x00\x3E'
+    NOT_RECOGNISED = b'\xE1\x00\x3E'
+    FLASH_ERROR = b'\xE6\x00\x3E'
+    COLD_RESET = b'\xE0\x08\x3E'
+    DEVICE_INFO = b'\xDC\xC4\x10'  # S12XEP100 maskset 1M48H (0xC410)
+
+    PPAGE = 0x30
+    FIRST_PAGE = 0xE0
+    LAST_PAGE = 0xFF
+    RAM_START = 0x2000
+    RAM_END = 0x4000
+    SM_START = 0xF800
+
+    def __init__(self, byte_us=86.8, erase_ms=20, erase_all_ms=200, drop_rate=0.0, corrupt_rate=0.0, stall_ms=0,
+                 seed=None):
+        super(SMEmulator, self).__init__()
+        self.daemon = True
+        self.byte_us = byte_us
+        self.erase_ms = erase_ms
+        self.erase_all_ms = erase_all_ms
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.stall_ms = stall_ms
+        self.random = random.Random(seed)
+
+        self.flash = dict((page, bytearray(b'\xFF' * 16384)) for page in xrange(self.FIRST_PAGE, self.LAST_PAGE + 1))
+        self.ram = bytearray(self.RAM_END - self.RAM_START)
+        self.monitor = bytearray(self.random.getrandbits(8) for _ in xrange(0x10000 - self.SM_START))
+        self.ppage = self.FIRST_PAGE
+        self.stats = {'commands': 0, 'rx_bytes': 0, 'tx_bytes': 0, 'dropped': 0, 'corrupted': 0}
+
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self._slave = slave
+        self._active = True
+
+    def stop(self):
+        self._active = False
+        self.join()
+        os.close(self.master)
+        os.close(self._slave)
+
+    def run(self):
+        buf = bytearray()
+        while self._active:
+            if not select.select([self.master], [], [], 0.05)[0]:
+                continue
+            try:
+                buf += os.read(self.master, 4096)
+            except OSError, ex:
+                if ex.errno == errno.EIO:  # Slave side closed
+                    time.sleep(0.01)
+                    continue
+                raise
+
+            while buf:
+                size = self.__command_size(buf)
+                if size is None or len(buf) < size:
+                    break
+                cmd = buf[:size]
+                del buf[:size]
+                self.stats['commands'] += 1
+                self.stats['rx_bytes'] += size
+                self.__respond(size, *self.__execute(cmd))
+
+    # -----
+
+    def __command_size(self, buf):
+        args = self.ARGS.get(buf[0], 0)
+        if buf[0] == 0xA8:
+            if len(buf) < 4:
+                return None
+            return 1 + args + buf[3] + 1
+        return 1 + args
+
+    def __execute(self, cmd):
+        """
+        Returns the response and the extra processing time in ms
+        """
+        op = cmd[0]
+        if op == 0x0D:
+            return self.COLD_RESET, 0
+        if op == 0xB4:
+            self.ppage = self.FIRST_PAGE
+            return b'', 0
+        if op == 0xB7:
+            return self.DEVICE_INFO + self.OK, 0
+        if op == 0xA2:
+            addr, value = struct.unpack_from('>HB', buffer(cmd), 1)
+            if addr == self.PPAGE:
+                self.ppage = value
+            return self.OK, 0
+        if op == 0xA7:
+            addr, length = struct.unpack_from('>HB', buffer(cmd), 1)
+            return self.__read(addr, length + 1) + self.OK, 0
+        if op == 0xA8:
+            addr, length = struct.unpack_from('>HB', buffer(cmd), 1)
+            return self.__write(addr, cmd[4:4 + length + 1]), 0
+        if op == 0xB8:
+            if self.ppage not in self.flash:
+                return self.FLASH_ERROR, 0
+            self.flash[self.ppage][:] = b'\xFF' * 16384
+            return self.OK, self.erase_ms
+        if op == 0xB6:
+            for page in self.flash.itervalues():
+                page[:] = b'\xFF' * 16384
+            return self.OK, self.erase_all_ms
+        return self.NOT_RECOGNISED, 0
+
+    def __read(self, addr, length):
+        if 0x8000 <= addr < 0xC000 and self.ppage in self.flash:
+            start = addr - 0x8000
+            return self.flash[self.ppage][start:start + length]
+        if self.RAM_START <= addr < self.RAM_END:
+            start = addr - self.RAM_START
+            return self.ram[start:start + length]
+        if addr >= self.SM_START:
+            start = addr - self.SM_START
+            return self.monitor[start:start + length]
+        return bytearray(length)
+
+    def __write(self, addr, data):
+        if 0x8000 <= addr < 0xC000 and self.ppage in self.flash:
+            page = self.flash[self.ppage]
+            start = addr - 0x8000
+            for i, value in enumerate(data):
+                page[start + i] &= value  # Programming can only clear bits
+            return self.OK
+        if self.RAM_START <= addr < self.RAM_END:
+            start = addr - self.RAM_START
+            self.ram[start:start + len(data)] = data
+            return self.OK
+        return self.FLASH_ERROR
+
+    def __respond(self, received, response, wait_ms):
+        delay = (received + len(response)) * self.byte_us / 1000000 + float(wait_ms) / 1000
+        if self.stall_ms:
+            delay += self.random.uniform(0, self.stall_ms) / 1000
+        time.sleep(delay)
+
+        if not response:
+            return
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            self.stats['dropped'] += 1
+            return
+        response = bytearray(response)
+        if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+            response[self.random.randrange(len(response))] ^= 0x5A
+            self.stats['corrupted'] += 1
+        os.write(self.master, bytes(response))
+        self.stats['tx_bytes'] += len(response)
+
+
+class EMSEmulator(threading.Thread):
+    """
+    Emulates a FreeEMS device in run mode on a pty (Linux/OS X only): answers the interface/firmware queries, the
+    location ID list and info requests and the RAM/flash reads and writes, and streams log packets (0x191) at log_hz.
+    Locations are filled with random data, flash and RAM start out equal. The trigger offset location is included,
+    the advance in the log packets follows its RAM value.
+
+    byte_us is the wire time of one byte, latency_ms the processing time of a request and flash_ms the extra time a
+    flash write takes. Faults: drop_rate is the probability of a response being lost, late_rate of it being sent
+    late_ms late (the responses after it wait behind it, the device answers in order) and requests for the locations
+    in dead_ids are never answered.
+    """
+    LOG_PAYLOAD = 0x191
+    LOG_SIZE = 100
+    ADVANCE_OFFSET = 54
+    META = {
+        Protocol.FE_CMD_INTERFACE: 'IFreeEMS Vanilla 1.0.0',
+        Protocol.FE_CMD_FIRMWARE: 'FreeEMS Vanilla v0.2.0-emulator',
+        Protocol.FE_CMD_DECODER: 'Emulated-36-1',
+        Protocol.FE_CMD_BUILDDATE: 'Jan  1 2014 00:00:00',
+        Protocol.FE_CMD_COMPILER: 'GCC 3.3.6-m68hc1x-20060122',
+        Protocol.FE_CMD_OSNAME: 'Linux',
+        Protocol.FE_CMD_USER: 'fuct',
+        Protocol.FE_CMD_EMAIL: 'fuct@localhost'
+    }
+
+    def __init__(self, locations=40, location_size=600, log_hz=0, byte_us=86.8, latency_ms=1, flash_ms=50,
+                 drop_rate=0.0, late_rate=0.0, late_ms=200, dead_ids=(), trigger=4500, seed=None):
+        super(EMSEmulator, self).__init__()
+        self.daemon = True
+        self.log_hz = log_hz
+        self.byte_us = byte_us
+        self.latency_ms = latency_ms
+        self.flash_ms = flash_ms
+        self.drop_rate = drop_rate
+        self.late_rate = late_rate
+        self.late_ms = late_ms
+        self.dead_ids = set(dead_ids)
+        self.random = random.Random(seed)
+
+        self.location_ids = [0x0100 + i for i in xrange(locations)]
+        self.flash = dict((lid, bytearray(self.random.getrandbits(8) for _ in xrange(location_size)))
+                          for lid in self.location_ids)
+        trigger_lid, trigger_offset = Protocol.FE_LOCATION_TRIGGER
+        self.location_ids.append(trigger_lid)
+        self.flash[trigger_lid] = bytearray(1024)
+        self.flash[trigger_lid][trigger_offset:trigger_offset + 2] = struct.pack('>H', trigger)
+        self.ram = dict((lid, bytearray(data)) for lid, data in self.flash.iteritems())
+        self.stats = {'requests': 0, 'responses': 0, 'log_packets': 0, 'dropped': 0, 'late': 0, 'ignored': 0}
+
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self._slave = slave
+        self._active = True
+        self._decoder = rx.FrameDecoder()
+        self._late = []  # (send time, packet)
+
+    def stop(self):
+        self._active = False
+        self.join()
+        os.close(self.master)
+        os.close(self._slave)
+
+    def trigger(self, memory='ram'):
+        data = (self.ram if memory == 'ram' else self.flash)[Protocol.FE_LOCATION_TRIGGER[0]]
+        return struct.unpack_from('>H', buffer(data), Protocol.FE_LOCATION_TRIGGER[1])[0]
+
+    def run(self):
+        next_log = time.time()
+        while self._active:
+            now = time.time()
+            if self.log_hz and now >= next_log:
+                next_log = max(next_log + 1.0 / self.log_hz, now)
+                self.__send_log()
+            while self._late and self._late[0][0] <= now:
+                self.__write(self._late.pop(0)[1])
+            if not select.select([self.master], [], [], 0.002)[0]:
+                continue
+            try:
+                chunk = os.read(self.master, 4096)
+            except OSError, ex:
+                if ex.errno == errno.EIO:  # Slave side closed
+                    time.sleep(0.01)
+                    continue
+                raise
+            time.sleep(len(chunk) * self.byte_us / 1000000)
+            for frame, size in self._decoder.feed(chunk):
+                if size >= 4 and sum(frame[:size - 1]) & 0xff == frame[size - 1]:
+                    self.stats['requests'] += 1
+                    self.__execute(frame[:size - 1])
+
+    # -----
+
+    def __execute(self, frame):
+        flags = frame[0]
+        payload = (frame[1] << 8) | frame[2]
+        body = frame[5:] if flags & 0x01 else frame[3:]
+
+        if payload in self.META:
+            return self.__respond(payload, bytearray(self.META[payload] + '\0'))
+        if payload == Protocol.FE_CMD_LOCATION_ID_LIST:
+            return self.__respond(payload, bytearray(struct.pack('>%dH' % len(self.location_ids),
+                                                                 *self.location_ids)))
+        if payload == Protocol.FE_CMD_LOCATION_ID_INFO:
+            lid = struct.unpack_from('>H', buffer(body))[0]
+            if lid not in self.flash:
+                return self.__respond(payload, nak=True)
+            return self.__respond(payload, bytearray(struct.pack('>HHBBHHH', 0, 0, 1, 1, 0x1000, 0x8000,
+                                                                 len(self.flash[lid]))), lid)
+        if payload in (Protocol.FE_CMD_RAM_READ, Protocol.FE_CMD_FLASH_READ):
+            lid, offset, size = struct.unpack_from('>HHH', buffer(body))
+            memory = self.ram if payload == Protocol.FE_CMD_RAM_READ else self.flash
+            if lid not in memory or offset + size > len(memory[lid]):
+                return self.__respond(payload, nak=True)
+            return self.__respond(payload, memory[lid][offset:offset + size], lid)
+        if payload in (Protocol.FE_CMD_RAM_WRITE, Protocol.FE_CMD_FLASH_WRITE):
+            lid, offset, size = struct.unpack_from('>HHH', buffer(body))
+            if lid not in self.flash or offset + size > len(self.flash[lid]) or len(body) < 6 + size:
+                return self.__respond(payload, nak=True)
+            self.ram[lid][offset:offset + size] = body[6:6 + size]
+            if payload == Protocol.FE_CMD_FLASH_WRITE:
+                self.flash[lid][offset:offset + size] = body[6:6 + size]
+                time.sleep(float(self.flash_ms) / 1000)
+            return self.__respond(payload, location_id=lid)
+        return self.__respond(payload, nak=True)
+
+    def __respond(self, payload, data=None, location_id=None, nak=False):
+        time.sleep(float(self.latency_ms) / 1000)
+        if location_id in self.dead_ids:
+            self.stats['ignored'] += 1
+            return
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            self.stats['dropped'] += 1
+            return
+        if nak:
+            frame = bytearray(struct.pack('>BH', 0x02, payload + 1))
+            frame.append(sum(frame) & 0xff)
+            packet = bytearray(b'\xAA') + Protocol.escape_packet(frame) + bytearray(b'\xCC')
+        else:
+            packet = Protocol.create_packet(payload + 1, data=data, use_length=data is not None)
+        late = self.late_rate and self.random.random() < self.late_rate
+        if late or self._late:
+            due = time.time()
+            if late:
+                self.stats['late'] += 1
+                due += float(self.late_ms) / 1000
+            self._late.append((max(due, self._late[-1][0]) if self._late else due, packet))
+            return
+        self.stats['responses'] += 1
+        self.__write(packet)
+
+    def __send_log(self):
+        data = bytearray(self.random.getrandbits(8) for _ in xrange(self.LOG_SIZE))
+        advance = self.trigger() / 10 + self.random.randint(0, 1)
+        data[self.ADVANCE_OFFSET:self.ADVANCE_OFFSET + 2] = struct.pack('>H', advance)
+        self.stats['log_packets'] += 1
+        self.__write(Protocol.create_packet(self.LOG_PAYLOAD, data=data, use_length=True))
+
+    def __write(self, packet):
+        time.sleep(len(packet) * self.byte_us / 1000000)
+        os.write(self.master, bytes(packet))
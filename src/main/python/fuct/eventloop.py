@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+
+__author__ = 'ari'
+
+import time
+import heapq
+import errno
+import select
+import logging
+import itertools
+import concurrent.futures as futures
+
+LOG = logging.getLogger('fuctlog')
+
+
+class Timer(object):
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    """
+    Single threaded select() loop over file descriptors (the serial port, stdin) and timers, the callbacks run in the
+    thread that runs the loop. select() only takes sockets on Windows, so the loop needs a POSIX system.
+    """
+
+    def __init__(self):
+        self._readers = {}  # fd -> callback
+        self._timers = []  # Heap of (when, sequence, Timer)
+        self._sequence = itertools.count()
+        self._running = False
+
+    def add_reader(self, fileobj, callback):
+        """
+        Calls callback() whenever fileobj (a file descriptor or an object with fileno()) is readable
+        """
+        self._readers[self.__fd(fileobj)] = callback
+
+    def remove_reader(self, fileobj):
+        self._readers.pop(self.__fd(fileobj), None)
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self._timers, (timer.when, next(self._sequence), timer))
+        return timer
+
+    def run(self):
+        """
+        Runs the loop until stop() is called
+        """
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        self._running = False
+
+    def run_until(self, future, timeout=None):
+        """
+        Runs the loop until the future is done and returns its result. Raises futures.TimeoutError if it is not
+        done in timeout seconds.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while not future.done():
+            wait = deadline - time.time() if deadline is not None else None
+            if wait is not None and wait <= 0:
+                raise futures.TimeoutError()
+            self.run_once(wait)
+        return future.result(0)
+
+    def run_once(self, timeout=None):
+        """
+        Waits for the first readable descriptor or timer (at most timeout seconds) and runs the callbacks that are due
+        """
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        if self._timers:
+            wait = max(self._timers[0][0] - time.time(), 0)
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        try:
+            readable = select.select(self._readers.keys(), [], [], timeout)[0]
+        except select.error, ex:
+            if ex.args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd in readable:
+            callback = self._readers.get(fd)
+            if callback is not None:
+                callback()
+
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+    # -----
+
+    @staticmethod
+    def __fd(fileobj):
+        return fileobj if isinstance(fileobj, (int, long)) else fileobj.fileno()
@@ -6,120 +6,320 @@
 
 __author__ = 'ari'
 
-import binascii
+import time
 import struct
-import Queue
 import log
+import collections
+import concurrent.futures as futures
 from collections import namedtuple
 from protocol import Protocol
 
 LOG = log.fuct_logger('fuctlog')
 
+LocationInfo = namedtuple('LocationInfo', ['flags', 'parent', 'ram_page', 'flash_page', 'ram_addr', 'flash_addr', 'size'])
+Location = namedtuple('Location', ['info', 'ram', 'flash'])
+
+
+class ResponseChannel(object):
+    """
+    Requests sharing one response ID. The responses carry nothing but the ID and the client matches them in order, so
+    a lost response shifts the later ones onto the wrong requests. The answers are trusted only once nothing with the
+    ID is in flight, and at most window requests are sent between those points. After a timeout every unsynced or in
+    flight request is sent again after a quiet period that lets the late responses drain.
+    """
+
+    def __init__(self):
+        self.inflight = []  # (key, args, attempt, future, send time) in send order
+        self.unsynced = []  # (key, args, attempt) answered while others were in flight
+        self.quiet_until = 0.0
+        self.echo = False  # A retry was sent right away, the previous attempt may still be answered
+
+    def can_send(self, attempt, window, now):
+        """
+        A retried request goes alone, nothing is sent while the channel is quiet or has window requests unsynced
+        """
+        if self.quiet_until > now or any(request[2] > 0 for request in self.inflight):
+            return False
+        if attempt > 0:
+            return not self.inflight
+        return len(self.unsynced) + len(self.inflight) < window
+
+    def sent(self, request):
+        self.inflight.append(request)
+
+    def answered(self, request):
+        """
+        Takes an answered request off the channel. Returns True if it was a retry sent right away.
+        """
+        self.inflight.remove(request)
+        if self.inflight:
+            self.unsynced.append(request[:3])
+        else:
+            del self.unsynced[:]  # Every request is answered, the answers are in order
+        echo, self.echo = self.echo, False
+        return echo
+
+    def reset(self):
+        """
+        Empties the channel. Returns the requests in flight and every request to send again.
+        """
+        cancelled = self.inflight
+        resend = self.unsynced + [request[:3] for request in cancelled]
+        self.inflight = []
+        self.unsynced = []
+        self.echo = False
+        return cancelled, resend
+
 
 class Interrogator(object):
+    """
+    Reads the metadata, the location table and the location contents from the device. Up to window requests are
+    kept in flight, the device answers them in order and the client matches the responses by payload ID. Locations
+    larger than chunk_size are read in chunks.
+
+    Every request has a deadline of timeout seconds (plus the wire time of the response) after the previous response,
+    an unanswered request is retried up to retries times after a quiet period with an exponential backoff (see
+    ResponseChannel). Nothing is sent after budget seconds, the location IDs that could not be read are listed in
+    failed after interrogate().
+    """
+    META_CMDS = [
+        ("interface", Protocol.FE_CMD_INTERFACE),
+        ("firmware", Protocol.FE_CMD_FIRMWARE),
+        ("decoder", Protocol.FE_CMD_DECODER),
+        ("build_date", Protocol.FE_CMD_BUILDDATE),
+        ("compiler", Protocol.FE_CMD_COMPILER),
+        ("os", Protocol.FE_CMD_OSNAME),
+        ("build_by", Protocol.FE_CMD_USER),
+        ("email", Protocol.FE_CMD_EMAIL)
+    ]
+    WINDOW = 4
+    CHUNK_SIZE = 256
+    INFO_SIZE = 12
+    TIMEOUT = 0.1
+    RETRIES = 3
+    BACKOFF = 0.02
+    BUDGET = 30.0
+    RESPONSE_SIZE = 64  # Expected response size of the requests without a size
+    REQUEST_SIZE = 16
 
-    def __init__(self, ser, queue_in, queue_out):
-        self.ser = ser
-        self.queue_in = queue_in
-        self.queue_out = queue_out
+    def __init__(self, client, timeout=TIMEOUT, window=WINDOW, chunk_size=CHUNK_SIZE, retries=RETRIES,
+                 backoff=BACKOFF, budget=BUDGET):
+        self.client = client
+        self.timeout = timeout
+        self.window = max(window, 1)
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.budget = budget
+        baudrate = getattr(client.ser, 'baudrate', None) or 115200
+        self.byte_time = 11.0 / baudrate  # Start, 8 data, parity and stop bits
+        self.stats = dict.fromkeys(('requests', 'retries', 'timeouts', 'errors', 'failed'), 0)
+        self.failed = []
+        self._channels = collections.defaultdict(ResponseChannel)  # Response ID -> ResponseChannel
 
     def get_metadata(self):
-        meta_cmds = [
-            ("interface", Protocol.FE_CMD_INTERFACE),
-            ("firmware", Protocol.FE_CMD_FIRMWARE),
-            ("decoder", Protocol.FE_CMD_DECODER),
-            ("build_date", Protocol.FE_CMD_BUILDDATE),
-            ("compiler", Protocol.FE_CMD_COMPILER),
-            ("os", Protocol.FE_CMD_OSNAME),
-            ("build_by", Protocol.FE_CMD_USER),
-            ("email", Protocol.FE_CMD_EMAIL)
-        ]
-        meta = {}
-        location_ids = None
-
-        for _, cmd in meta_cmds:
-            self.queue_out.put(Protocol.create_packet(cmd))
-
-        self.queue_out.put(Protocol.create_packet(Protocol.FE_CMD_LOCATION_ID_LIST, data=bytearray(b'\x00\x00\x00'), use_length=True))
-
-        while True:
-            if all(name in meta for name, _ in meta_cmds) and location_ids is not None:
-                break
+        requests = [(name, (cmd,)) for name, cmd in self.META_CMDS]
+        requests.append(('location_ids',
+                         (Protocol.FE_CMD_LOCATION_ID_LIST, None, None, bytearray(b'\x00\x00\x00'), True)))
+        results = self.pipeline(requests)
+        if any(not done for done, _ in results.itervalues()):
+            self.failed = [name for name, (done, _) in sorted(results.iteritems()) if not done]
+            raise ValueError('Device did not answer the interrogation (%s)' % ', '.join(self.failed))
 
-            try:
-                if not self.queue_out.empty():
-                    packet = self.queue_out.get(False)
-                    LOG.debug("--> %s" % binascii.hexlify(packet[1:-2]))
-                    self.ser.write(packet)
-                    self.ser.flush()
-
-                    resp = self.queue_in.get()
-                    LOG.debug("<-- %s" % binascii.hexlify(resp))
-                    data = Protocol.decode_packet(resp)
-
-                    # FIXME: hax, make more elegant
-                    meta_info = [(name, data[1].decode("ascii").rstrip('\0')) for name, cmd_id in meta_cmds if cmd_id + 1 == data[0]]
-                    if meta_info:
-                        m = meta_info[0]
-                        LOG.debug("Received meta: %s" % m[0])
-                        meta[m[0]] = m[1]
-                    elif data[0] == Protocol.FE_CMD_LOCATION_ID_LIST + 1:
-                        ids = len(data[1]) / 2
-                        LOG.debug("Received %d location IDs" % ids)
-                        location_ids = struct.unpack_from(">%dH" % ids, buffer(data[1]))
-
-                    # TODO: error message handling
-
-            except Queue.Empty:
-                pass
+        meta = dict((name, str(results[name][1] or '').rstrip('\0')) for name, _ in self.META_CMDS)
+        data = results['location_ids'][1] or ''
+        ids = len(data) / 2
+        LOG.debug("Received %d location IDs" % ids)
+        location_ids = struct.unpack_from(">%dH" % ids, buffer(data))
 
         return meta, location_ids
 
+    def interrogate(self, location_ids, cached=None, read_ram=True):
+        """
+        Reads the info and the RAM and flash contents of the locations. Returns a dict of location ID -> Location,
+        the contents are None if the location has no RAM/flash copy or reading it failed (or RAM was not read).
+
+        The info and flash contents of the locations in cached (a dict of location ID -> Location, eg. from the
+        interrogation cache) are not read again.
+        """
+        cached = cached or {}
+        deadline = time.time() + self.budget
+        infos = self.pipeline([(lid, (Protocol.FE_CMD_LOCATION_ID_INFO, None, None, struct.pack(">H", lid)))
+                               for lid in location_ids if lid not in cached], deadline)
+        locations = {}
+        reads = []
+        for lid in location_ids:
+            if lid in cached:
+                info = locations[lid] = cached[lid].info
+            else:
+                done, data = infos[lid]
+                if not done or data is None or len(data) < self.INFO_SIZE:
+                    LOG.warn("Failed to load location info 0x%04x" % lid)
+                    continue
+                info = locations[lid] = LocationInfo(*struct.unpack_from(">HHBBHHH", buffer(data)))
+                if info.flash_page > 0:
+                    reads.extend(self.__chunks(Protocol.FE_CMD_FLASH_READ, (lid, 0), info.size, ('flash', lid)))
+            if read_ram and info.ram_page > 0:
+                reads.extend(self.__chunks(Protocol.FE_CMD_RAM_READ, (lid, 0), info.size, ('ram', lid)))
+
+        contents = self.__join_chunks(self.pipeline(reads, deadline))
+        for lid, info in locations.items():
+            flash = cached[lid].flash if lid in cached else contents.get(('flash', lid))
+            locations[lid] = Location(info, contents.get(('ram', lid)), flash)
+
+        self.failed = sorted(lid for lid in location_ids if lid not in locations or
+                             (locations[lid].info.flash_page > 0 and locations[lid].flash is None) or
+                             (read_ram and locations[lid].info.ram_page > 0 and locations[lid].ram is None))
+        if self.failed:
+            LOG.warn("Failed to read locations: %s" % ", ".join("0x%04x" % lid for lid in self.failed))
+        return locations
+
     def get_location_info(self, location_id):
         LOG.debug("Get location info: 0x%02x" % location_id)
-        packet = Protocol.create_packet(Protocol.FE_CMD_LOCATION_ID_INFO, data=struct.pack(">H", location_id))
-        LOG.debug("--> %s" % binascii.hexlify(packet[1:-2]))
-        self.ser.write(packet)
-        self.ser.flush()
-
-        locinfo = namedtuple('LocationInfo', ['flags', 'parent', 'ram_page', 'flash_page', 'ram_addr', 'flash_addr', 'size'])
-        resp = self.queue_in.get(5)
-        if resp:
-            LOG.debug("<-- %s" % binascii.hexlify(resp))
-            data = Protocol.decode_packet(resp)
-            if data[0] == Protocol.FE_CMD_LOCATION_ID_INFO + 1:
-                return locinfo(*struct.unpack_from(">HHBBHHH", buffer(data[1])))
-        else:
-            LOG.warn("Failed to load location...")
+        done, data = self.pipeline([(location_id, (Protocol.FE_CMD_LOCATION_ID_INFO, None, None,
+                                                   struct.pack(">H", location_id)))])[location_id]
+        if done and data is not None and len(data) >= self.INFO_SIZE:
+            return LocationInfo(*struct.unpack_from(">HHBBHHH", buffer(data)))
+        LOG.warn("Failed to load location...")
 
     def get_ram_data(self, location, size):
         LOG.debug("Get RAM location: 0x%02x, offset: %d, size: %d" % (location[0], location[1], size))
-        packet = Protocol.create_packet(Protocol.FE_CMD_RAM_READ, location, size)
-        LOG.debug("--> %s" % binascii.hexlify(packet[1:-2]))
-        self.ser.write(packet)
-        self.ser.flush()
-
-        resp = self.queue_in.get(5)
-        if resp:
-            LOG.debug("<-- %s" % binascii.hexlify(resp))
-            data = Protocol.decode_packet(resp)
-            if data[0] == Protocol.FE_CMD_RAM_READ + 1:
-                return data[1]
-        else:
-            LOG.warn("Failed to load location...")
+        return self.__read(Protocol.FE_CMD_RAM_READ, location, size)
 
     def get_flash_data(self, location, size):
         LOG.debug("Get FLASH location: 0x%02x, offset: %d, size: %d" % (location[0], location[1], size))
-        packet = Protocol.create_packet(Protocol.FE_CMD_FLASH_READ, location, size)
-        LOG.debug("--> %s" % binascii.hexlify(packet[1:-2]))
-        self.ser.write(packet)
-        self.ser.flush()
-
-        resp = self.queue_in.get(5)
-        if resp:
-            LOG.debug("<-- %s" % binascii.hexlify(resp))
-            data = Protocol.decode_packet(resp)
-            if data[0] == Protocol.FE_CMD_FLASH_READ + 1:
-                return data[1]
+        return self.__read(Protocol.FE_CMD_FLASH_READ, location, size)
+
+    def pipeline(self, requests, deadline=None):
+        """
+        Sends the requests ((key, client.request arguments) pairs) keeping up to window of them in flight and returns
+        a dict of key -> (answered, response data). Requests unanswered at deadline (default: budget seconds from now)
+        fail, error responses fail without retries.
+        """
+        if deadline is None:
+            deadline = time.time() + self.budget
+        queue = collections.deque((key, args, 0) for key, args in requests)
+        inflight = collections.deque()  # (key, args, attempt, future, send time) in send order
+        results = {}
+        last = time.time()  # Time of the previous response, the device answers in order
+
+        while queue or inflight:
+            self.__send(queue, inflight, deadline)
+            now = time.time()
+            if not inflight:
+                if now >= deadline:
+                    for key, _, _ in queue:
+                        LOG.debug("Request %s not sent, out of time" % (key,))
+                        results[key] = (False, None)
+                    break
+                wake = min([c.quiet_until for c in self._channels.itervalues() if c.quiet_until > now] + [deadline])
+                time.sleep(max(wake - now, 0))  # Waiting for a quiet period to end
+                continue
+
+            request = inflight[0]
+            key, args, attempt, future, sent = request
+            channel = self._channels[future.response_id]
+            wait = min(max(sent, last) + self.timeout + self.__wire_time(args), deadline) - now
+            try:
+                results[key] = (True, future.result(max(wait, 0)))
+            except futures.TimeoutError:
+                LOG.debug("Request %s timed out (attempt %d)" % (key, attempt + 1))
+                self.stats['timeouts'] += 1
+                self.__resend(channel, attempt, queue, inflight, results, deadline)
+                last = time.time()
+                continue
+            except (ValueError, futures.CancelledError), ex:
+                LOG.debug("Request %s failed: %s" % (key, ex))
+                self.stats['errors'] += 1
+                results[key] = (False, None)
+            inflight.popleft()
+            last = time.time()
+            if channel.answered(request) and results[key][0]:
+                channel.quiet_until = last + 2 * self.timeout  # A late response to the previous attempt may follow
+
+        self.stats['failed'] += sum(1 for done, _ in results.itervalues() if not done)
+        return results
+
+    # -----
+
+    def __send(self, queue, inflight, deadline):
+        """
+        Sends queued requests until the window is full, skipping the ones their response channel cannot take yet
+        """
+        now = time.time()
+        i = 0
+        while len(inflight) < self.window and i < len(queue) and now < deadline:
+            key, args, attempt = queue[i]
+            channel = self._channels[args[0] + 1]
+            if not channel.can_send(attempt, self.window, now):
+                i += 1
+                continue
+            del queue[i]
+            request = (key, args, attempt, self.client.request(*args), time.time())
+            inflight.append(request)
+            channel.sent(request)
+            self.stats['requests'] += 1
+
+    def __resend(self, channel, attempt, queue, inflight, results, deadline):
+        """
+        Cancels the requests of the channel and queues them to be sent again after a quiet period, the requests out
+        of retries (or time) fail
+        """
+        cancelled, resend = channel.reset()
+        drain = 0.0  # Wire time of the responses to the cancelled requests
+        for request in cancelled:
+            inflight.remove(request)
+            self.client.cancel(request[3])
+            drain += self.__wire_time(request[1])
+        retry = []
+        for key, args, tries in resend:
+            if tries < self.retries and time.time() < deadline:
+                results.pop(key, None)
+                retry.append((key, args, tries + 1))
+                self.stats['retries'] += 1
+            else:
+                results[key] = (False, None)
+        queue.extendleft(reversed(retry))
+        quiet = self.backoff * 2 ** attempt
+        if len(resend) == 1:
+            channel.echo = bool(retry)  # Retried right away, the quiet period follows the retry
         else:
-            LOG.warn("Failed to load location...")
\ No newline at end of file
+            quiet += 2 * self.timeout + drain
+        channel.quiet_until = time.time() + quiet
+
+    def __wire_time(self, args):
+        size = args[2] if len(args) > 2 and args[2] is not None else self.RESPONSE_SIZE
+        return (size + self.REQUEST_SIZE) * self.byte_time
+
+    def __chunks(self, payload, location, size, key):
+        """
+        Requests of a location read split into chunk_size pieces, keyed by (key, offset, size)
+        """
+        lid, offset = location
+        return [((key, start, min(self.chunk_size, size - start)),
+                 (payload, (lid, offset + start), min(self.chunk_size, size - start)))
+                for start in xrange(0, size, self.chunk_size)]
+
+    @staticmethod
+    def __join_chunks(results):
+        """
+        Joins the chunks of every read back together, a read with a missing or short chunk is None
+        """
+        contents = {}
+        for (key, start, size), (done, data) in sorted(results.iteritems()):
+            if key in contents and contents[key] is None:
+                continue
+            if not done or data is None or len(data) != size:
+                LOG.warn("Failed to load location %s 0x%04x" % key)
+                contents[key] = None
+                continue
+            contents.setdefault(key, bytearray()).extend(data)
+        return contents
+
+    def __read(self, payload, location, size):
+        key = ('read', location[0])
+        contents = self.__join_chunks(self.pipeline(self.__chunks(payload, location, size, key)))
+        data = contents.get(key)
+        if data is None:
+            LOG.warn("Failed to load location...")
+        return data
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+
+__author__ = 'ari'
+
+import os
+import json
+import logging
+
+LOG = logging.getLogger('fuctlog')
+
+
+class LoadJournal(object):
+    """
+    Small JSON journal kept next to the firmware file while it is loaded. It records the SHA-256 of the firmware
+    and the state of every page so an interrupted load can be resumed from the first incomplete page. The tag
+    (the port name when loading several devices at once) keeps the journals of parallel loads apart. When the
+    firmware directory is not writable the journal goes to ~/.fuct/journal instead.
+    """
+    LOADING = 'loading'
+    WRITTEN = 'written'
+    VERIFIED = 'verified'
+    EXT = '.journal'
+    FALLBACK_DIR = os.path.join(os.path.expanduser('~'), '.fuct', 'journal')
+
+    def __init__(self, path, image_key, pages=None, fallback=None):
+        self.path = path
+        self.image_key = image_key
+        self.pages = pages if pages is not None else {}
+        self.fallback = fallback
+
+    @classmethod
+    def journal_path(cls, filepath, tag=None):
+        return "%s%s%s" % (filepath, '.' + tag if tag else '', cls.EXT)
+
+    @classmethod
+    def fallback_path(cls, image_key, tag=None):
+        return cls.journal_path(os.path.join(cls.FALLBACK_DIR, image_key), tag)
+
+    @classmethod
+    def for_firmware(cls, filepath, image_key, tag=None):
+        return cls(cls.journal_path(filepath, tag), image_key, fallback=cls.fallback_path(image_key, tag))
+
+    @classmethod
+    def open(cls, filepath, image_key, tag=None):
+        """
+        Returns the journal of an interrupted load of the same image or None if there is nothing to resume
+        """
+        path = cls.find(filepath, image_key, tag)
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                content = json.load(f)
+        except ValueError:
+            LOG.warning("Load journal %s is corrupt, ignoring it" % path)
+            return None
+        if content.get('image') != image_key:
+            LOG.warning("Load journal %s is for a different firmware, ignoring it" % path)
+            return None
+        pages = dict((int(page, 16), state) for page, state in content['pages'].iteritems())
+        return cls(path, image_key, pages, fallback=cls.fallback_path(image_key, tag))
+
+    @classmethod
+    def find(cls, filepath, image_key, tag=None):
+        """
+        Returns the path of the existing journal next to the firmware or in the fallback directory, None if neither
+        """
+        for path in (cls.journal_path(filepath, tag), cls.fallback_path(image_key, tag)):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    @classmethod
+    def exists(cls, filepath, image_key, tag=None):
+        return cls.find(filepath, image_key, tag) is not None
+
+    def state(self, page):
+        return self.pages.get(page)
+
+    def done(self, page):
+        return self.pages.get(page) in (self.WRITTEN, self.VERIFIED)
+
+    def mark(self, page, state):
+        self.pages[page] = state
+        self.save()
+
+    def forget(self, page):
+        self.pages.pop(page, None)
+        self.save()
+
+    def save(self):
+        """
+        Writes the journal. If it cannot be written it moves to the fallback path, if that fails too the load goes on
+        without a journal and cannot be resumed.
+        """
+        if self.path is None:
+            return
+        try:
+            self.__write(self.path)
+            return
+        except (IOError, OSError), ex:
+            error = ex
+        if self.fallback is not None and self.fallback != self.path:
+            LOG.warning("Cannot write load journal %s (%s), keeping it in %s" % (self.path, error, self.fallback))
+            self.path = self.fallback
+            try:
+                if not os.path.isdir(os.path.dirname(self.path)):
+                    os.makedirs(os.path.dirname(self.path))
+                self.__write(self.path)
+                return
+            except (IOError, OSError), ex:
+                error = ex
+        LOG.warning("Cannot write load journal %s (%s), resume unavailable" % (self.path, error))
+        self.path = None
+
+    def remove(self):
+        if self.path is not None and os.path.isfile(self.path):
+            os.remove(self.path)
+
+    # -----
+
+    def __write(self, path):
+        content = {'image': self.image_key, 'pages': dict(('%02x' % page, state) for page, state in self.pages.iteritems())}
+        tmpname = path + '.tmp'
+        with open(tmpname, 'w') as f:
+            f.write(json.dumps(content, sort_keys=True))
+        os.rename(tmpname, path)
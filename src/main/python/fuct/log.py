@@ -10,9 +10,9 @@ import logging
 from colorlog import ColoredFormatter
 
 
-def fuct_logger(name):
+def fuct_logger(name, threads=False):
     formatter = ColoredFormatter(
-        "%(log_color)s%(levelname)-8s%(reset)s %(message)s",
+        "%(log_color)s%(levelname)-8s%(reset)s " + ("[%(threadName)s] " if threads else "") + "%(message)s",
         datefmt=None,
         reset=True,
         log_colors={
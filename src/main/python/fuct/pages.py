@@ -7,58 +7,109 @@
 __author__ = 'ari'
 
 import logging
+import hashlib
 
 LOG = logging.getLogger('fuctlog')
 
 
-class MemoryPage:
-    MAXSIZE = 16384
-
-    def __init__(self, page, address, data=None):
-        self.page = page
-        self.address = address
-        self.data = data
-
-    def add_data(self, data):
-        if self.data is None:
-            self.data = data
+class FlashImage(object):
+    """
+    Sparse image of the paged flash. Every PPAGE window (0x8000-0xBFFF) touched by the firmware is kept as a 16k
+    bytearray prefilled with the erased value (gap filling), a coverage mask for overlap detection and a dirty flag
+    for each 256 byte block that holds image data.
+    """
+    PAGE_START = 0x8000
+    PAGE_END = 0xC000
+    PAGE_SIZE = 16384
+    BLOCK_SIZE = 256
+    BLOCKS = PAGE_SIZE / BLOCK_SIZE
+    ERASED = 0xFF
+
+    BLANK_PAGE = bytearray([ERASED]) * PAGE_SIZE
+    BLANK_BLOCK = bytearray([ERASED]) * BLOCK_SIZE
+    COVERED = bytearray([1]) * PAGE_SIZE
+
+    def __init__(self):
+        self.data = {}
+        self.mask = {}
+        self.dirty = {}
+        self.size = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def add(self, page, address, data):
+        length = len(data)
+        if address < self.PAGE_START or address + length > self.PAGE_END:
+            raise ValueError('Data @ 0x%04x (%d bytes) is out of range for page 0x%02x' % (address, length, page))
+
+        pdata = self.data.get(page)
+        if pdata is None:
+            pdata = self.data[page] = self.BLANK_PAGE[:]
+            self.mask[page] = bytearray(self.PAGE_SIZE)
+            self.dirty[page] = bytearray(self.BLOCKS)
+
+        start = address - self.PAGE_START
+        end = start + length
+        mask = self.mask[page]
+        if mask.find(b'\x01', start, end) != -1:
+            if pdata[start:end] != data:
+                raise ValueError('Overlapping data with different content @ 0x%02x:0x%04x' % (page, address))
+            LOG.debug("Identical overlapping data @ 0x%02x:0x%04x" % (page, address))
         else:
-            self.data += data
-
-
-def records_to_pages(records):
-    pages = []
-    page = None
-    last_addr = curr_page = 0
-    total_size = 0
+            self.size += length
+
+        pdata[start:end] = data
+        mask[start:end] = self.COVERED[:length]
+        first = start / self.BLOCK_SIZE
+        last = (end - 1) / self.BLOCK_SIZE + 1
+        self.dirty[page][first:last] = self.COVERED[:last - first]
+
+    def pages(self):
+        return sorted(self.data)
+
+    def page_data(self, page):
+        return self.data[page]
+
+    def page_digest(self, page):
+        return hashlib.sha1(self.data[page]).digest()
+
+    def read(self, page, address, length):
+        start = address - self.PAGE_START
+        return memoryview(self.data[page])[start:start + length]
+
+    def blocks(self, page, skip_blank=True):
+        """
+        Yields (address, data) of the dirty blocks of the page in address order. Blocks that contain only the erased
+        value are skipped as they are already in that state after the page erase.
+        """
+        pdata = self.data[page]
+        view = memoryview(pdata)
+        for block, dirty in enumerate(self.dirty[page]):
+            if dirty:
+                start = block * self.BLOCK_SIZE
+                end = start + self.BLOCK_SIZE
+                if skip_blank and pdata.startswith(self.BLANK_BLOCK, start, end):
+                    continue
+                yield self.PAGE_START + start, view[start:end]
+
+    def block_count(self, page=None, skip_blank=True):
+        if page is None:
+            return sum(self.block_count(p, skip_blank) for p in self.data)
+        return sum(1 for _ in self.blocks(page, skip_blank))
+
+
+def records_to_image(records, image=None):
+    if image is None:
+        image = FlashImage()
 
     for rec in records:
         if rec.stype[0] == 'S2':
-            rpage = rec.get_page()
-            address = rec.get_page_address()
-            rec_size = len(rec.data)
-            if rec_size:
-                if rpage == curr_page and address == last_addr:
-                    last_addr = add_to_page(page, rec.data, last_addr)
-                else:
-                    if page is not None:
-                        pages.append(page)
-
-                    page = MemoryPage(rpage, address)
-                    curr_page = rpage
-                    last_addr = add_to_page(page, rec.data, address)
-                total_size += rec_size
+            if len(rec.data):
+                image.add(rec.get_page(), rec.get_page_address(), rec.data)
             else:
                 LOG.warning("Record has no data, skipping...")
-
         else:
             LOG.warning("%s records are not supported, skipping..." % rec.stype[0])
 
-    pages.append(page)  # TODO: add to for loops last round
-
-    return pages, total_size
-
-
-def add_to_page(page, data, address):
-    page.add_data(data)
-    return address + len(data)
\ No newline at end of file
+    return image
@@ -32,61 +32,39 @@ class Protocol(object):
     FE_LOCATION_STREAM = (0x9000, 0x0000)  # 1 byte, 0 = disable, 1 = enable
     FE_LOCATION_TRIGGER = (0xC003, 0x0060)  # 2 bytes
 
-    @staticmethod
-    def create_packet(payload, location=None, size=None, data=None, use_length=False):
-
-        # -----
-        beef = bytearray()
-        if location is not None:
-            beef.extend(struct.pack('>HH', location[0], location[1]))
-
-        if size is not None:
-            beef.extend(struct.pack('>H', size))
-
-        if data is not None:
-            beef.extend(data)
-        # -----
-        beef_size = len(beef)
-        msg = bytearray()
-
-        if use_length and beef_size > 0:
-            msg.append(0x01)
-        else:
-            msg.append(0x00)
-
-        msg.extend(struct.pack('>H', payload))
-
-        if use_length and beef_size > 0:
-            msg.extend(struct.pack('>H', beef_size))
-
-        if beef_size > 0:
-            msg.extend(beef)
+    _templates = {}
+    TEMPLATE_CACHE_SIZE = 256
 
-        checksum = sum(msg) & 0xff
-        msg.append(checksum)
-
-        msg = Protocol.escape_packet(msg)
-        msg.insert(0, 0xAA)
-        msg.append(0xCC)
+    @staticmethod
+    def template(payload, location=None, size=None, data_size=0, use_length=False):
+        """
+        Returns the cached PacketTemplate of a packet shape, the header and its checksum are computed only once
+        """
+        key = (payload, location, size, data_size, use_length)
+        tmpl = Protocol._templates.get(key)
+        if tmpl is None:
+            if len(Protocol._templates) >= Protocol.TEMPLATE_CACHE_SIZE:
+                Protocol._templates.clear()
+            tmpl = Protocol._templates[key] = PacketTemplate(payload, location, size, data_size, use_length)
+        return tmpl
 
-        return msg
+    @staticmethod
+    def create_packet(payload, location=None, size=None, data=None, use_length=False):
+        data_size = len(data) if data is not None else 0
+        tmpl = Protocol._templates.get((payload, location, size, data_size, use_length))
+        if tmpl is None:
+            tmpl = Protocol.template(payload, location, size, data_size, use_length)
+        return tmpl.build(data)
 
     @staticmethod
     def escape_packet(data):
-        edata = bytearray()
-        for c in data:
-            if c == 0xAA:
-                edata.extend(b'\xBB\x55')
-            elif c == 0xBB:
-                edata.extend(b'\xBB\x44')
-            elif c == 0xCC:
-                edata.extend(b'\xBB\x33')
-            else:
-                edata.append(c)
-        return edata
+        # Escape byte first, the later replaces insert escape bytes of their own
+        return bytearray(str(data).replace('\xBB', '\xBB\x44').replace('\xAA', '\xBB\x55').replace('\xCC', '\xBB\x33'))
 
     @staticmethod
     def decode_packet(data):
+        if isinstance(data, PacketView):
+            return data.payload, data.data if len(data.data) else None
         flags = data[0]
         payload = (data[1] << 8) + data[2]
         length = 0
@@ -97,3 +75,100 @@ class Protocol(object):
             return payload, data[5:(length + 5)]
         else:
             return payload, None
+
+
+class PacketTemplate(object):
+    """
+    Precompiled packet shape. The escaped start byte and header (flags, payload ID, length, location and size) and
+    the checksum of the header are built once, build() only sums and escapes the variable data.
+    """
+
+    def __init__(self, payload, location=None, size=None, data_size=0, use_length=False):
+        beef = bytearray()
+        if location is not None:
+            beef.extend(struct.pack('>HH', location[0], location[1]))
+
+        if size is not None:
+            beef.extend(struct.pack('>H', size))
+
+        beef_size = len(beef) + data_size
+        header = bytearray()
+        if use_length and beef_size > 0:
+            header.extend(struct.pack('>BHH', 0x01, payload, beef_size))
+        else:
+            header.extend(struct.pack('>BH', 0x00, payload))
+        header.extend(beef)
+
+        self.data_size = data_size
+        self.header_sum = sum(header)
+        self.prefix = bytearray(b'\xAA') + Protocol.escape_packet(header)
+        self.packet = self.prefix + self.__escaped_tail(None) + b'\xCC'  # Complete packet of data-less shapes
+
+    def build(self, data=None):
+        if data is None:
+            return self.packet[:]
+        msg = self.prefix + self.__escaped_tail(data)
+        msg.append(0xCC)
+        return msg
+
+    def build_into(self, buf, offset=0, data=None):
+        """
+        Writes the packet into a caller supplied bytearray (or writable memoryview) at offset and returns the offset
+        after it. The buffer must have room for the escaped packet, at most twice the unescaped size.
+        """
+        end = offset + len(self.prefix)
+        buf[offset:end] = self.prefix
+        tail = self.__escaped_tail(data)
+        offset, end = end, end + len(tail)
+        buf[offset:end] = tail
+        buf[end] = 0xCC
+        return end + 1
+
+    def __escaped_tail(self, data):
+        if data is None:
+            return Protocol.escape_packet(chr(self.header_sum & 0xff))
+        if len(data) != self.data_size:
+            raise ValueError('Packet data is %d bytes, template expects %d' % (len(data), self.data_size))
+        tail = bytearray(data)
+        tail.append((self.header_sum + sum(tail)) & 0xff)
+        return Protocol.escape_packet(tail)
+
+
+class PacketView(object):
+    """
+    Decoded packet as parsed header fields and a memoryview of the data in a pooled frame buffer. Fields can be read
+    from the data without copying (eg. struct.unpack_from). release() hands the buffer back to the pool, the view
+    must not be used after that.
+    """
+    __slots__ = ('flags', 'payload', 'length', 'data', '_buf', '_pool')
+
+    def __init__(self, buf, size, pool=None):
+        """
+        buf holds the unescaped frame (header, data and checksum) in its first size bytes
+        """
+        self.flags = buf[0]
+        self.payload = (buf[1] << 8) + buf[2]
+        header = 3
+        if self.flags & 0x01:
+            self.length = (buf[3] << 8) + buf[4]
+            header = 5
+        else:
+            self.length = size - header - 1
+        self.data = memoryview(buf)[header:size - 1]
+        self._buf = buf
+        self._pool = pool
+
+    def __len__(self):
+        return len(self.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def release(self):
+        if self._pool is not None:
+            self.data = None
+            self._pool.release(self._buf)
+            self._pool = self._buf = None
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+
+__author__ = 'ari'
+
+import struct
+import hashlib
+import logging
+from common import QueueWriter
+from srecord import SRecord, STYPES
+from pages import FlashImage
+
+LOG = logging.getLogger('fuctlog')
+
+
+class RipWriter(QueueWriter):
+    """
+    Writes ripped pages to disk on its own thread so the serial reads never wait for hashing, formatting or the disk.
+    Pages and 256 byte blocks that hold only the erased value are left out of the output.
+
+    Formats:
+      s19  S0 header, S2 records of record_size bytes and an S8 termination, loadable with fuctloader
+      bin  sparse binary, the non-blank blocks of every page followed by a page index and a footer:
+             index   page number, data offset and 64 bit map of the stored blocks for every page
+             footer  index offset, page count, magic
+    """
+    FORMATS = ('s19', 'bin')
+    MAGIC = 'FUCTRIP'
+    INDEX = struct.Struct('>BIQ')
+    FOOTER = struct.Struct('>IH7s')
+
+    def __init__(self, filepath, fmt='s19', header='fuct rip', record_size=32, queue_size=4):
+        if fmt not in self.FORMATS:
+            raise ValueError('Unknown rip format "%s"' % fmt)
+        super(RipWriter, self).__init__(queue_size)
+        self.filepath = filepath
+        self.fmt = fmt
+        self.header = header
+        self.record_size = record_size
+        self.sha = hashlib.sha256()
+        self.stats = {'pages': 0, 'blank_pages': 0, 'blocks': 0, 'blank_blocks': 0, 'bytes': 0}
+        self._index = []
+        self._file = None
+
+    def put(self, page, data):
+        """
+        Queues a full 16k page for writing. The writer takes ownership of data.
+        """
+        QueueWriter.put(self, (page, data))
+
+    def close(self):
+        """
+        Waits until every queued page is written. Returns the SHA-256 of the ripped pages.
+        """
+        QueueWriter.close(self)
+        return self.sha.hexdigest()
+
+    def begin(self):
+        self._file = open(self.filepath, 'wb')
+        if self.fmt == 's19':
+            self._file.write(SRecord(STYPES['S0'], 0, bytearray(self.header)).to_line() + '\n')
+
+    def handle(self, item):
+        self.__write_page(self._file, *item)
+
+    def end(self):
+        f = self._file
+        if self.fmt == 's19':
+            f.write(SRecord(STYPES['S8'], 0).to_line() + '\n')
+        else:
+            index_offset = f.tell()
+            for entry in self._index:
+                f.write(self.INDEX.pack(*entry))
+            f.write(self.FOOTER.pack(index_offset, len(self._index), self.MAGIC))
+
+    def __write_page(self, f, page, data):
+        self.stats['pages'] += 1
+        self.sha.update(chr(page))
+        self.sha.update(data)
+        if data == FlashImage.BLANK_PAGE:
+            self.stats['blank_pages'] += 1
+            return
+
+        view = memoryview(data)
+        offset = f.tell()
+        block_map = 0
+        for block in xrange(FlashImage.BLOCKS):
+            start = block * FlashImage.BLOCK_SIZE
+            end = start + FlashImage.BLOCK_SIZE
+            if data.startswith(FlashImage.BLANK_BLOCK, start, end):
+                self.stats['blank_blocks'] += 1
+                continue
+            self.stats['blocks'] += 1
+            self.stats['bytes'] += FlashImage.BLOCK_SIZE
+            block_map |= 1 << block
+            if self.fmt == 'bin':
+                f.write(view[start:end])
+            else:
+                lines = []
+                for rstart in xrange(start, end, self.record_size):
+                    address = (page << 16) | (FlashImage.PAGE_START + rstart)
+                    lines.append(SRecord(STYPES['S2'], address, view[rstart:rstart + self.record_size]).to_line())
+                lines.append('')
+                f.write('\n'.join(lines))
+
+        if self.fmt == 'bin':
+            self._index.append((page, offset, block_map))
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
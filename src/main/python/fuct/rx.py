@@ -6,87 +6,228 @@
 
 __author__ = 'ari'
 
+import time
+import itertools
 import threading
+import collections
 import Queue
 import log
+from protocol import PacketView
 
 LOG = log.fuct_logger('fuctlog')
 
 
+class FrameDecoder(object):
+    """
+    Splits the escaped byte stream into frames a read chunk at a time. The end and escape bytes are found with
+    str.find() and the runs between the escapes are copied straight into the frame buffer, so Python code runs per
+    frame and per escape instead of per byte and the frame data is copied once. The escaped bytes of a frame that
+    continues in the next chunk are kept until its end byte arrives.
+
+    The frame buffers come from acquire(size), a buffer of at least size bytes (eg. BufferPool.acquire).
+    """
+    START = '\xAA'
+    END = '\xCC'
+    ESCAPE = '\xBB'
+    ESCAPES = {'\x55': 0xAA, '\x44': 0xBB, '\x33': 0xCC}  # Byte after the escape byte -> value
+
+    def __init__(self, acquire=bytearray):
+        self.acquire = acquire
+        self._partial = None  # Escaped pieces of the frame in progress, None outside a frame
+        self.resyncs = 0  # Start bytes in the middle of a frame
+
+    def feed(self, chunk):
+        """
+        Returns the frames completed by the chunk as (buffer, size) pairs, the first size bytes of the buffer hold the
+        unescaped frame (header, data and checksum)
+        """
+        frames = []
+        partial = self._partial
+        pos = 0
+        end = chunk.find(self.END)
+        while end != -1:
+            # The last start byte before the end byte starts the frame, an earlier one was a frame cut short
+            start = chunk.rfind(self.START, pos, end)
+            if start != -1:
+                frames.append(self.unescape(chunk, start + 1, end))
+                self.resyncs += chunk.count(self.START, pos, start) + (partial is not None)
+            elif partial is not None:
+                partial.append(chunk[pos:end])
+                frame = ''.join(partial)
+                frames.append(self.unescape(frame, 0, len(frame)))
+            partial = None
+            pos = end + 1
+            end = chunk.find(self.END, pos)
+
+        start = chunk.rfind(self.START, pos)
+        if start != -1:
+            self.resyncs += chunk.count(self.START, pos, start) + (partial is not None)
+            partial = [chunk[start + 1:]]
+        elif partial is not None:
+            partial.append(chunk[pos:])
+        self._partial = partial
+        return frames
+
+    def unescape(self, data, start, end):
+        """
+        Unescapes data[start:end] into a buffer and returns (buffer, size). An invalid escape is dropped together with
+        the byte after it.
+        """
+        buf = self.acquire(end - start)
+        view = memoryview(buf)
+        escape = data.find(self.ESCAPE, start, end)
+        if escape == -1:
+            view[:end - start] = buffer(data, start, end - start)
+            return buf, end - start
+
+        size = 0
+        while escape != -1:
+            run = escape - start
+            view[size:size + run] = buffer(data, start, run)
+            size += run
+            if escape + 1 < end:
+                value = self.ESCAPES.get(data[escape + 1])
+                if value is not None:
+                    buf[size] = value
+                    size += 1
+            start = escape + 2
+            escape = data.find(self.ESCAPE, start, end)
+        if start < end:
+            view[size:size + end - start] = buffer(data, start, end - start)
+            size += end - start
+        return buf, size
+
+
+class BufferPool(object):
+    """
+    Recycles the frame buffers handed out with PacketViews. Released buffers are kept for reuse up to count, frames
+    larger than buffer_size get a buffer of their own.
+    """
+
+    def __init__(self, buffer_size=2048, count=256):
+        self.buffer_size = buffer_size
+        self.count = count
+        self.allocated = 0
+        self._free = collections.deque()
+
+    def acquire(self, size=0):
+        if size > self.buffer_size:
+            return bytearray(size)
+        try:
+            return self._free.pop()
+        except IndexError:
+            self.allocated += 1
+            return bytearray(self.buffer_size)
+
+    def release(self, buf):
+        if len(buf) == self.buffer_size and len(self._free) < self.count:
+            self._free.append(buf)
+
+
 class RxThread(threading.Thread):
-    def __init__(self, ser, queue_in, queue_log=None):
+    """
+    Reads the serial port, validates the frames and routes them into the incoming and log queues. Frames with a bad
+    checksum or a length field that does not match the frame size are dropped and counted, see stats().
+
+    Log packets are put into the log queue (or passed to on_log) as PacketViews over pooled buffers, the consumer
+    must release() them.
+    Responses are few and kept by their consumers, they are put into the incoming queue (or passed to on_response)
+    as bytearrays of the frame without the checksum.
+    """
+    COUNTERS = ('good_frames', 'bad_checksum', 'length_mismatch', 'resyncs', 'queue_drops', 'bytes')
+
+    def __init__(self, ser, queue_in, queue_log=None, on_response=None, on_log=None):
         super(RxThread, self).__init__()
         self.ser = ser
         self.buffer_size = 1024
         self.queue_in = queue_in
         self.queue_log = queue_log
+        self.on_response = on_response
+        self.on_log = on_log
         self.logging = False
+        self.pool = BufferPool()
+        self.counters = dict((name, 0) for name in self.COUNTERS)
+        self._decoder = FrameDecoder(self.pool.acquire)
+        self._rate_mark = (time.time(), 0)
         self._active = True
 
     def stop(self):
         self._active = False
 
-    def run(self):
-        in_packet = False
-        in_escape = False
-        outbuf = bytearray()
+    def stats(self):
+        """
+        Returns a snapshot of the counters and the bytes/s received since the previous call
+        """
+        self.counters['resyncs'] = self._decoder.resyncs
+        stats = dict(self.counters)
+        now = time.time()
+        mark_time, mark_bytes = self._rate_mark
+        stats['bytes_per_sec'] = (stats['bytes'] - mark_bytes) / (now - mark_time) if now > mark_time else 0.0
+        self._rate_mark = (now, stats['bytes'])
+        return stats
 
+    def run(self):
         LOG.debug("Starting RX thread")
         while self._active:
 
-            # Incoming
-            buf = self.ser.read(self.buffer_size)
-
-            for c in buf:
-                if ord(c) == 0xAA:
-                    if in_packet:
-                        """ Start byte in the middle of a packet, start fresh """
-                        in_escape = False
-                        outbuf = bytearray()
-
-                    in_packet = True
-
-                elif ord(c) == 0xCC and in_packet:
-                    in_packet = False
-
-                    size = len(outbuf)
-                    flags = outbuf[0]
-                    payload = (outbuf[1] << 8) + outbuf[2]
-                    length = 0
-                    if flags == 0x01:
-                        length = (outbuf[3] << 8) + outbuf[4]
-                    checksum1 = outbuf.pop()
-
-                    # Check checksum
-                    checksum2 = sum(outbuf) & 0xff
-                    if (size == length + 5) or (checksum1 == checksum2):
-                        if payload == 0x191:  # log packet
-                            try:
-                                if self.logging and self.queue_log is not None:
-                                    self.queue_log.put(outbuf[5:], False)
-                            except Queue.Full:
-                                pass
-                        else:
-                            self.queue_in.put(outbuf)
-
-                    outbuf = bytearray()
-
-                else:
-                    if in_packet and not in_escape:
-                        """ Escape next byte """
-                        if ord(c) == 0xBB:
-                            in_escape = True
-                        else:
-                            outbuf += c
-
-                    elif in_packet and in_escape:
-                        if ord(c) == 0x55:
-                            outbuf += chr(0xAA)
-                        elif ord(c) == 0x44:
-                            outbuf += chr(0xBB)
-                        elif ord(c) == 0x33:
-                            outbuf += chr(0xCC)
-
-                        in_escape = False
-
-        LOG.debug("Exiting RX thread")
\ No newline at end of file
+            # Incoming, block for the first byte and then take what has arrived so a response is handled at once
+            buf = self.ser.read(1)
+            if buf:
+                waiting = self.ser.inWaiting()
+                if waiting:
+                    buf += self.ser.read(min(waiting, self.buffer_size))
+                self.feed(buf)
+
+        LOG.debug("Exiting RX thread")
+
+    def feed(self, buf):
+        """
+        Decodes and dispatches received data, for reading the port from an event loop instead of the thread
+        """
+        self.counters['bytes'] += len(buf)
+        for buf, size in self._decoder.feed(buf):
+            self.__dispatch(buf, size)
+
+    def __dispatch(self, buf, size):
+        counters = self.counters
+        if size < 4:  # Flags, payload ID and checksum at least
+            counters['length_mismatch'] += 1
+            self.pool.release(buf)
+            return
+
+        if sum(itertools.islice(buf, size - 1)) & 0xff != buf[size - 1]:
+            counters['bad_checksum'] += 1
+            self.pool.release(buf)
+            return
+
+        if buf[0] & 0x01 and (size < 6 or size != ((buf[3] << 8) + buf[4]) + 6):  # Header, data and checksum
+            counters['length_mismatch'] += 1
+            self.pool.release(buf)
+            return
+
+        counters['good_frames'] += 1
+        if buf[1] == 0x01 and buf[2] == 0x91:  # log packet
+            if self.logging and self.on_log is not None:
+                self.on_log(PacketView(buf, size, self.pool))
+                return
+            if self.logging and self.queue_log is not None:
+                packet = PacketView(buf, size, self.pool)
+                try:
+                    self.queue_log.put(packet, False)
+                    return
+                except Queue.Full:
+                    counters['queue_drops'] += 1
+            self.pool.release(buf)
+        else:
+            response = buf[:size - 1]
+            self.pool.release(buf)
+            if self.on_response is not None:
+                self.on_response(response)
+            else:
+                self.queue_in.put(response)
+
+
+def format_stats(stats):
+    return "%d frames ok, %d bad checksum, %d length mismatch, %d resyncs, %d queue drops, %.1f kB/s" % \
+           (stats['good_frames'], stats['bad_checksum'], stats['length_mismatch'], stats['resyncs'],
+            stats['queue_drops'], stats['bytes_per_sec'] / 1000)
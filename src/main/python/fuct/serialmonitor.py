@@ -11,7 +11,10 @@ import logging
 import binascii
 import hashlib
 import common
-from time import sleep
+import timing
+from srecord import SRecord, STYPES
+from math import ceil
+from time import time
 from struct import pack, unpack_from
 from serial import SerialTimeoutException
 
@@ -22,7 +25,7 @@ class SMResponse():
     def __init__(self, response, status, data=None):
         self.response_code = response
         self.status_code = status
-        self.data = data[:]  # Copy data
+        self.data = data  # View into the device RX buffer, valid until the next command
 
     def __str__(self):
         return "SM response code 0x%02x, status code 0x%02x, data %d bytes" % \
@@ -96,15 +99,36 @@ class SMDevice():
     # Misc
     DEVICE_INFO_CONSTANT = 0xDC
     BLOCK_SIZE = 256
+    ERASE_PAGE_MS = 330
+    ERASE_ALL_MS = 4000  # Worst case for the bulk erase
+    FIRST_PAGE = 0xE0
+    LAST_PAGE = 0xFF
+    CALIBRATION_ADDR = 0x2000  # RAM, blocks are read and written back unchanged
+    CALIBRATION_SIZES = (1, 16, 64, 128, 256)
 
     # SM versions TODO: add more versions
     SM_VERSIONS = {
         'e886a55bf927f9c86cad5d26ca41ba88': 'Motorola SM v2.2 (with USB hack)'
     }
 
-    def __init__(self, ser):
+    def __init__(self, ser, profile=None):
         self.ser = ser
-        self.ns_per_byte = 86805  # 10 ^ 6ns / 115200 * 10 = 86.805ns per byte
+        self.baudrate = getattr(ser, 'baudrate', 115200)
+        self.ns_per_byte = 10 ** 10 / self.baudrate  # 10 bits per byte, 86805ns @ 115200
+        self.timeout_ms = 100  # Slack added to every command deadline (USB latency timers etc.)
+        self._rxbuf = bytearray(self.BLOCK_SIZE + 8)
+        self._rxview = memoryview(self._rxbuf)
+        if profile is not None:
+            self.apply_profile(profile)
+
+    def apply_profile(self, profile):
+        if profile.get('baud') != self.baudrate:
+            LOG.debug("Timing profile is for %s baud, using defaults for %d baud" % (profile.get('baud'), self.baudrate))
+            return False
+        self.ns_per_byte = profile['ns_per_byte']
+        self.timeout_ms = profile['timeout_ms']
+        LOG.debug("Timing profile: %d ns/byte, %d ms timeout" % (self.ns_per_byte, self.timeout_ms))
+        return True
 
     # Highlevel commands
 
@@ -136,21 +160,21 @@ class SMDevice():
             else:
                 raise ValueError("Invalid device info constant (0x%02x), should be 0x%02x" % (cid, self.DEVICE_INFO_CONSTANT))
         else:
-            raise ValueError("Invalid device info size (%d bytes), should be 3 bytes" % len(resp))
+            raise ValueError("Invalid device info size (%d bytes), should be 3 bytes" % len(resp.data))
 
     def analyse_device(self, rip=False):
-        # TODO: Interim serialmonitor ripper solution (should make S19 files)
-        if rip:
-            sm_file = open('serialmonitor.dat', 'w')
-            sm_file.write("# Ripped serialmonitor range (F800-FF00)\n# Format: <memory address>:::<hexdata (256 bytes)>\n")
         smdata = bytearray()
         for addr in range(0xF800, 0x10000, 256):
             resp = self.__read_block(addr, 0xFF)
             smdata += resp.data
-            if rip:
-                sm_file.write("%04x:::%s\n" % (addr, binascii.hexlify(resp.data)))
+
         if rip:
-            sm_file.close()
+            # Ripped serialmonitor range (F800-FFFF) as S1 records
+            with open('serialmonitor.s19', 'w') as sm_file:
+                sm_file.write(SRecord(STYPES['S0'], 0, bytearray('serialmonitor')).to_line() + '\n')
+                for offset in range(0, len(smdata), 32):
+                    sm_file.write(SRecord(STYPES['S1'], 0xF800 + offset, smdata[offset:offset + 32]).to_line() + '\n')
+                sm_file.write(SRecord(STYPES['S9'], 0).to_line() + '\n')
 
         if len(smdata) != 2048:
             raise ValueError('Invalid SM size (%d bytes), should be 2k' % len(smdata))
@@ -171,75 +195,152 @@ class SMDevice():
 
         return True
 
-    def erase_and_write(self, mempage, erase=True, verify=True):
-        if mempage.address < 0x8000 or mempage.address >= 0xC000:
-            raise ValueError('Address 0x%04x is out of range for page 0x%02x' % (mempage.address, mempage.page))
-
-        if len(mempage.data) > 0xC000 - mempage.address:
-            raise ValueError('Invalid amount of data (%d bytes), will overflow page 0x%02x @ 0x%04x' %
-                             (len(mempage.data), mempage.page, mempage.address))
-
+    def write_page(self, image, page, erase=True, verify=True):
+        """
+        Erases the page once and writes the dirty blocks of it from the flash image in a single ordered pass.
+        Returns the measured erase time in seconds (None if not erased).
+        """
+        erase_time = None
         if erase:
-            self.__set_page(mempage.page)
-            self.__erase_page()
-
-        blocks = len(mempage.data) / self.BLOCK_SIZE
-        trailing = len(mempage.data) % self.BLOCK_SIZE
-        start_block = 0
-        start_addr = mempage.address
-
-        for block in range(0, blocks):
-            block_data = mempage.data[start_block:start_block + self.BLOCK_SIZE]
-            start_block += self.BLOCK_SIZE
+            erase_time = self.erase_page(page)
+        else:
+            self.__set_page(page)
 
-            self.__write_block(start_addr, block_data)
+        for addr, block_data in image.blocks(page):
+            if self.__write_block(addr, block_data) is None:
+                raise ValueError('Writing block failed @ 0x%02x:0x%04x' % (page, addr))
 
             if verify:
-                read_back = self.__read_block(start_addr, self.BLOCK_SIZE - 1)
-                if block_data != read_back.data:
-                    raise ValueError('Verification failed @ 0x%04x' % start_addr)
+                read_back = self.__read_block(addr, len(block_data) - 1)
+                if read_back is None or block_data != read_back.data:
+                    raise ValueError('Verification failed @ 0x%02x:0x%04x' % (page, addr))
 
-            start_addr += self.BLOCK_SIZE
+        return erase_time
 
-        if trailing > 0:  # TODO: add trailing write to for loop and verify
-            block_data = mempage.data[-trailing:]
-            self.__write_block(start_addr, block_data)
-
-    def rip_pages(self, start, end, filepath):
-        last = end + 1
-        pages = last - start
+    def page_matches(self, image, page, quick=False):
+        """
+        Reads back the blocks of the page written from the image and compares them by hash. A quick check reads only
+        the first and the last block.
+        """
+        blocks = list(image.blocks(page))
+        if quick and len(blocks) > 2:
+            blocks = [blocks[0], blocks[-1]]
+
+        self.__set_page(page)
+        dev_hash = hashlib.sha1()
+        img_hash = hashlib.sha1()
+        for addr, block_data in blocks:
+            resp = self.__read_block(addr, len(block_data) - 1)
+            if resp is None:
+                return False
+            dev_hash.update(resp.data)
+            img_hash.update(block_data)
+        return dev_hash.digest() == img_hash.digest()
 
-        # TODO: saving raw data is good enough?
-        f = open(filepath, 'a+')
-        for i, page in enumerate(xrange(start, last)):
-            progress = float(i) / pages
-            common.print_progress(progress)
-            self.__set_page(page)
-            f.write(self.__read_page())
-        f.close()
-
-        sys.stdout.write("\r")
-        sys.stdout.flush()
-        LOG.info("Firmware ripped successfully")
-
-    def erase_pages(self, start, end):
-        total = end - start
-        last = end + 1
-        counter = 0
-        for page in xrange(start, last):
+    def rip_pages(self, pages, writer):
+        """
+        Reads the pages and hands them to a RipWriter, formatting and disk I/O happen on the writer thread
+        """
+        for i, page in enumerate(pages):
+            common.check_stop()
+            common.print_progress(float(i) / len(pages))
             self.__set_page(page)
-            self.__erase_page()
+            writer.put(page, self.__read_page())
+        common.print_progress(1.0)
+
+    def erase_page(self, page):
+        """
+        Erases a single page and returns the measured erase time in seconds. The erase ends when the prompt
+        arrives, ERASE_PAGE_MS is only the deadline.
+        """
+        self.__set_page(page)
+        time1 = time()
+        if self.__erase_page() is None:
+            raise ValueError('Erasing page 0x%02x failed' % page)
+        return time() - time1
+
+    def erase_pages(self, pages):
+        """
+        Erases the given pages one by one, returns a list of (page, erase time in seconds)
+        """
+        times = []
+        for counter, page in enumerate(pages):
+            common.check_stop()
+            times.append((page, self.erase_page(page)))
             if LOG.getEffectiveLevel() == logging.INFO:
-                progress = float(counter) / total
-                common.print_progress(progress)
-            counter += 1
+                common.print_progress(float(counter + 1) / len(pages))
         if LOG.getEffectiveLevel() == logging.INFO:
             sys.stdout.write("\r")
             sys.stdout.flush()
 
         LOG.info("Firmware erased successfully")
 
-        return True
+        return times
+
+    def erase_all(self):
+        """
+        Bulk erases the flash (the serial monitor is protected). Returns the measured erase time in seconds or None
+        if the monitor did not accept the command.
+        """
+        time1 = time()
+        if self.__write_and_read(3, self.CMD_ERASE_ALL, self.ERASE_ALL_MS) is None:
+            return None
+        return time() - time1
+
+    def prefer_bulk_erase(self, page_count):
+        return page_count * self.ERASE_PAGE_MS > self.ERASE_ALL_MS
+
+    def read_page(self, page):
+        self.__set_page(page)
+        return self.__read_page()
+
+    def estimate_write_time(self, size, pages=0, verify=True):
+        """
+        Rough wire time in seconds for writing (and reading back) size bytes and erasing the given amount of pages
+        """
+        blocks = (size + self.BLOCK_SIZE - 1) / self.BLOCK_SIZE
+        wire_bytes = size + blocks * 7  # command, address, length and response trailer
+        if verify:
+            wire_bytes *= 2
+        return float(wire_bytes * self.ns_per_byte) / 1000000000 + float(pages * self.ERASE_PAGE_MS) / 1000
+
+    def calibrate(self, sizes=CALIBRATION_SIZES, rounds=8):
+        """
+        Measures round trips of reading a RAM block and writing it back unchanged for every payload size, then fits
+        the wire time per byte and the fixed latency of the link. Returns the timing profile and a list of
+        (size, average read seconds, average write seconds).
+        """
+        points = []
+        measurements = []
+        for size in sizes:
+            read_total = write_total = 0.0
+            for _ in xrange(rounds):
+                time1 = time()
+                resp = self.__read_block(self.CALIBRATION_ADDR, size - 1)
+                if resp is None:
+                    raise ValueError('Reading calibration block failed')
+                data = bytearray(resp.data)
+                time2 = time()
+                if self.__write_block(self.CALIBRATION_ADDR, data) is None:
+                    raise ValueError('Writing calibration block failed')
+                time3 = time()
+                # Both commands move 4 header bytes, the payload and the 3 byte trailer
+                points.append((size + 7, time2 - time1))
+                points.append((size + 7, time3 - time2))
+                read_total += time2 - time1
+                write_total += time3 - time2
+            measurements.append((size, read_total / rounds, write_total / rounds))
+
+        latency, per_byte = timing.fit_line(points)
+        latency = max(latency, 0)
+        worst = max(y - (latency + per_byte * x) for x, y in points)
+        profile = {
+            'baud': self.baudrate,
+            'ns_per_byte': max(int(per_byte * 1000000000), 10 ** 10 / self.baudrate),
+            'latency_ms': round(latency * 1000, 2),
+            'timeout_ms': int(ceil((latency + max(worst, 0)) * 2000)) + 10
+        }
+        return profile, measurements
 
     def reinit(self):
         if self.__reset() is not None:
@@ -276,23 +377,23 @@ class SMDevice():
         self.__write_byte(self.SM_PPAGE, page)
 
     def __erase_page(self):
-        # 330ms read delay can be a bit lower but this should be safe
-        return self.__write_and_read(3, self.CMD_ERASE_PAGE, 330)
+        # 330ms is the worst case, the prompt usually arrives earlier and ends the read
+        return self.__write_and_read(3, self.CMD_ERASE_PAGE, self.ERASE_PAGE_MS)
 
     def __device_info(self):
         return self.__write_and_read(6, self.CMD_DEVICE_INFO)
 
     def __reset(self):
         if self.__write_command(self.CMD_RESET) is not None:
-            rdata = self.__get_data_after_wait(5, 2)
-            if len(rdata) <= 1:
-                return SMResponse(None, None, rdata)
+            received = self.__read_response(5, 1, 2)
+            if received <= 1:
+                return SMResponse(None, None, self._rxview[:received])
         return None
 
     def __open_comm(self):
         if self.__write_command(self.SM_OPEN) is not None:
-            rdata = self.__get_data_after_wait(4)
-            if self.__check_open_response(rdata, 1 if len(rdata) == 4 else 0) is not None:
+            received = self.__read_response(4, 1)
+            if self.__check_open_response(received, 1 if received == 4 else 0) is not None:
                 return True
         return None
 
@@ -303,7 +404,8 @@ class SMDevice():
             cmd_bytes = self.ser.write(chr(cmd))
             if cmd_bytes > 0:
                 if args is not None:
-                    LOG.debug("--> %s" % binascii.hexlify(args))
+                    if LOG.isEnabledFor(logging.DEBUG):
+                        LOG.debug("--> %s" % binascii.hexlify(args))
                     arg_bytes = self.ser.write(args)
                     if arg_bytes > 0:
                         return cmd_bytes + arg_bytes
@@ -329,7 +431,7 @@ class SMDevice():
             LOG.error("Block has %d bytes, needs to be 256 bytes or less" % len(data))
             return None
 
-        args = self.__get_addr_data(addr, len(data) - 1)
+        args = bytearray(self.__get_addr_data(addr, len(data) - 1))
         args += data
 
         return self.__write_and_read(3, self.CMD_WRITE_BLOCK, 0, args)
@@ -340,49 +442,61 @@ class SMDevice():
             return None
 
         if self.__write_command(command, args) is not None:
-            offset = resp_length - 3
             sent_bytes = 1 if args is None else len(args) + 1
-            total_bytes = sent_bytes + resp_length
-            rdata = self.__get_data_after_wait(total_bytes, wait_ms)
+            received = self.__read_response(resp_length, sent_bytes, wait_ms)
 
-            return self.__check_response(rdata, offset if len(rdata) == resp_length else 0)
+            return self.__check_response(received, resp_length - 3 if received == resp_length else 0)
         return None
 
-    def __get_data_after_wait(self, total_bytes, wait_ms=0):
-        if total_bytes <= 0:
+    def __read_response(self, resp_length, sent_bytes=0, wait_ms=0):
+        """
+        Reads a response into the RX buffer and returns the amount of bytes received. The read ends as soon as
+        resp_length bytes have arrived or, for short responses, when a trailer (RC, SC, prompt) is seen. Otherwise
+        it gives up at the command deadline which is the wire time of the whole exchange plus wait_ms and timeout_ms.
+        """
+        if resp_length <= 0:
             LOG.warning("Requested total bytes of response is zero or less.")
-
-        # Sleep at least 1 ms before reading. Remember sleep operation is OS specific and cannot be guaranteed
-        # to be accurate. Use ns_per_byte to fine tune the read delay per byte.
-        pre_sleep = (float(total_bytes * self.ns_per_byte) / 1000000) + wait_ms
-        LOG.debug("~ %.2f ms (%d bytes)" % (pre_sleep, total_bytes))
-        sleep(pre_sleep / 1000 if pre_sleep > 1 else 1)
-
-        data = self.ser.read(total_bytes)
-        LOG.debug("<-- %s" % binascii.hexlify(data))
-        return data
-
-    def __check_open_response(self, data, offset=0):
-        if len(data) < 3:
+            return 0
+
+        deadline = time() + float((sent_bytes + resp_length) * self.ns_per_byte) / 1000000000 + \
+            float(wait_ms + self.timeout_ms) / 1000
+        buf = self._rxbuf
+        received = 0
+        while received < resp_length:
+            received += self.ser.readinto(self._rxview[received:resp_length])
+            if resp_length <= 4 and received >= 3 and buf[received - 1] == self.SM_PROMPT and \
+                    (buf[received - 3] != self.RC_NO_ERROR or buf[received - 2] != self.SC_MONITOR_ACTIVE):
+                break  # Short error/status response, no point waiting for more
+            if time() > deadline:
+                break
+
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("<-- %s (%d/%d bytes)" % (binascii.hexlify(self._rxview[:received]), received, resp_length))
+        return received
+
+    def __check_open_response(self, received, offset=0):
+        if received < 3:
             LOG.error('Invalid open response (too few bytes)')
             return None
 
-        resp = tuple([ord(x) for x in data[offset:offset + 3]])
+        buf = self._rxbuf
+        resp = (buf[offset], buf[offset + 1], buf[offset + 2])
         if resp == (self.RC_NO_ERROR, self.SC_COLD_RESET_EXECUTED, self.SM_PROMPT) or \
                 resp == (self.RC_NOT_RECOGNISED, self.SC_MONITOR_ACTIVE, self.SM_PROMPT):
-            return SMResponse(resp[0], resp[1], data)
+            return SMResponse(resp[0], resp[1], self._rxview[:received])
 
         LOG.error('Invalid open response, is device in load/SM mode?')
         return None
 
-    def __check_response(self, data, offset):
-        if len(data) < offset + 3:
+    def __check_response(self, received, offset):
+        if received < offset + 3:
             LOG.error('Invalid response (too few bytes)')
             return None
 
-        resp = tuple([ord(x) for x in data[offset:offset + 3]])
+        buf = self._rxbuf
+        resp = (buf[offset], buf[offset + 1], buf[offset + 2])
         if resp == (self.RC_NO_ERROR, self.SC_MONITOR_ACTIVE, self.SM_PROMPT):
-            return SMResponse(resp[0], resp[1], data[:-3])
+            return SMResponse(resp[0], resp[1], self._rxview[:offset])
 
         LOG.error('Invalid response (no prompt or unrecognized command)')
         return None
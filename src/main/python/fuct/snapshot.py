@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+
+__author__ = 'ari'
+
+import os
+import mmap
+import struct
+import logging
+import tempfile
+from interrogator import Location, LocationInfo
+
+LOG = logging.getLogger('fuctlog')
+
+
+class Snapshot(object):
+    """
+    Read-only, memory mapped snapshot of the interrogated locations (the tune a log was recorded with).
+
+    Format:
+      header  magic, version, location count, flags (CACHED_FLASH: the flash contents came from the interrogation
+              cache, not from the device)
+      index   location ID, location info and the offset/length of the RAM and flash contents for every location,
+              sorted by location ID (offset 0 = contents not available)
+      blobs   raw RAM and flash contents
+
+    The contents are returned as buffers into the mapping, nothing is copied until the caller does so.
+    """
+    MAGIC = 'FUCTSNP'
+    VERSION = 2
+    HEADER = struct.Struct('>7sBHB')
+    CACHED_FLASH = 0x01
+    INDEX = struct.Struct('>HHHBBHHHIIII')
+    EXT = 'snap'
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._file = open(filepath, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, count, self.flags = self.HEADER.unpack_from(self._map, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError('%s is not a snapshot file' % filepath)
+            self._index = {}
+            for i in xrange(count):
+                entry = self.INDEX.unpack_from(self._map, self.HEADER.size + i * self.INDEX.size)
+                self._index[entry[0]] = entry
+        except (ValueError, struct.error, mmap.error), ex:
+            self._file.close()
+            raise ValueError('Unreadable snapshot %s (%s)' % (filepath, ex))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def location_ids(self):
+        return sorted(self._index)
+
+    def info(self, location_id):
+        return LocationInfo(*self.__entry(location_id)[1:8])
+
+    def ram(self, location_id):
+        return self.__blob(*self.__entry(location_id)[8:10])
+
+    def flash(self, location_id):
+        return self.__blob(*self.__entry(location_id)[10:12])
+
+    def location(self, location_id):
+        return Location(self.info(location_id), self.ram(location_id), self.flash(location_id))
+
+    @classmethod
+    def write(cls, filepath, locations, flags=0):
+        """
+        Writes a dict of location ID -> Location (the result of Interrogator.interrogate) into a snapshot file
+        """
+        lids = sorted(locations)
+        index = []
+        offset = cls.HEADER.size + cls.INDEX.size * len(lids)
+        for lid in lids:
+            loc = locations[lid]
+            entry = [lid] + list(loc.info)
+            for data in (loc.ram, loc.flash):
+                entry.extend((offset, len(data)) if data is not None else (0, 0))
+                offset += len(data) if data is not None else 0
+            index.append(entry)
+
+        dirname = os.path.dirname(os.path.abspath(filepath))
+        fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.fchmod(fd, 0666 & ~umask)  # mkstemp creates 0600, give it the mode of the logfile next to it
+        with os.fdopen(fd, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(lids), flags))
+            for entry in index:
+                f.write(cls.INDEX.pack(*entry))
+            for lid in lids:
+                for data in (locations[lid].ram, locations[lid].flash):
+                    if data is not None:
+                        f.write(data)
+        os.rename(tmpname, filepath)
+        LOG.debug("Wrote %d locations (%d bytes) to %s" % (len(lids), offset, filepath))
+
+    # -----
+
+    def __entry(self, location_id):
+        entry = self._index.get(location_id)
+        if entry is None:
+            raise ValueError('Location 0x%04x is not in the snapshot' % location_id)
+        return entry
+
+    def __blob(self, offset, size):
+        return buffer(self._map, offset, size) if offset else None
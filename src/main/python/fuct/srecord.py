@@ -7,7 +7,7 @@
 __author__ = 'ari'
 
 import binascii
-from struct import unpack_from
+from struct import pack
 
 STYPES = {
     'S0': ('S0', 2, True),
@@ -24,6 +24,7 @@ STYPES = {
 
 
 class SRecord(object):
+    __slots__ = ('stype', 'address', 'data')
 
     def __init__(self, stype, address, data=None):
         self.stype = stype
@@ -32,16 +33,27 @@ class SRecord(object):
         # TODO: validate data and address
 
     def __str__(self):
-        return "S-record (%s) @ <%s> with %d bytes" % (self.stype[0], binascii.hexlify(self.address), len(self.data))
+        return "S-record (%s) @ <%0*x> with %d bytes" % (self.stype[0], self.stype[1] * 2, self.address, len(self.data))
 
     def get_page(self):
-        if self.stype[0] != 'S2' or len(self.address) != 3:
-            raise TypeError('Paging in %s records is not supported or not enough address bytes' % self.stype[0])
+        if self.stype[0] != 'S2':
+            raise TypeError('Paging in %s records is not supported' % self.stype[0])
 
-        return int(self.address[0])
+        return self.address >> 16
 
     def get_page_address(self):
-        if self.stype[0] != 'S2' or len(self.address) != 3:
-            raise TypeError('Paging in %s records is not supported or not enough address bytes' % self.stype[0])
-
-        return unpack_from('>H', self.address[-2:])[0]
\ No newline at end of file
+        if self.stype[0] != 'S2':
+            raise TypeError('Paging in %s records is not supported' % self.stype[0])
+
+        return self.address & 0xFFFF
+
+    def to_line(self):
+        """
+        Formats the record as an S19 line without the line ending
+        """
+        data = self.data if self.data is not None else ''
+        body = bytearray(pack('>BI', self.stype[1] + len(data) + 1, self.address))
+        del body[1:5 - self.stype[1]]  # Keep only the address bytes of the record type
+        body += data
+        body.append(~sum(body) & 0xFF)
+        return self.stype[0] + binascii.hexlify(body).upper()
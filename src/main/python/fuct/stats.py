@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+
+__author__ = 'ari'
+
+import math
+import collections
+
+
+class RollingStats(object):
+    """
+    Min, max, mean, standard deviation and a jitter histogram of the last size integer samples (eg. raw ignition
+    advance values). add() takes constant time: the sums are kept up to date as samples enter and leave the window
+    and min/max come from monotonic queues. Integer sums keep the mean and deviation exact however long it runs.
+
+    The jitter histogram counts the sample to sample changes in the window, bin i is a change of i - jitter_bins
+    (changes beyond +-jitter_bins are counted in the outermost bins).
+    """
+
+    def __init__(self, size=50, jitter_bins=5):
+        self.size = size
+        self.jitter_bins = jitter_bins
+        self.reset()
+
+    def reset(self):
+        self.histogram = [0] * (2 * self.jitter_bins + 1)
+        self._values = collections.deque()
+        self._jitter = collections.deque()  # Histogram bins of the changes in the window
+        self._min = collections.deque()  # (index, value), increasing values
+        self._max = collections.deque()  # (index, value), decreasing values
+        self._sum = 0
+        self._sum_sq = 0
+        self._index = 0
+
+    def add(self, value):
+        values = self._values
+        if values:
+            change = min(max(value - values[-1], -self.jitter_bins), self.jitter_bins)
+            self._jitter.append(change + self.jitter_bins)
+            self.histogram[change + self.jitter_bins] += 1
+
+        values.append(value)
+        self._sum += value
+        self._sum_sq += value * value
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((self._index, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((self._index, value))
+
+        if len(values) > self.size:
+            old = values.popleft()
+            self._sum -= old
+            self._sum_sq -= old * old
+            self.histogram[self._jitter.popleft()] -= 1
+            first = self._index - self.size + 1
+            if self._min[0][0] < first:
+                self._min.popleft()
+            if self._max[0][0] < first:
+                self._max.popleft()
+        self._index += 1
+
+    @property
+    def count(self):
+        return len(self._values)
+
+    @property
+    def min(self):
+        return self._min[0][1] if self._min else None
+
+    @property
+    def max(self):
+        return self._max[0][1] if self._max else None
+
+    @property
+    def mean(self):
+        return float(self._sum) / len(self._values) if self._values else None
+
+    @property
+    def stddev(self):
+        n = len(self._values)
+        if not n:
+            return None
+        return math.sqrt(max(n * self._sum_sq - self._sum * self._sum, 0)) / n
+
+    def jitter(self):
+        """
+        Returns the non-empty histogram bins as (change, count) pairs
+        """
+        return [(i - self.jitter_bins, count) for i, count in enumerate(self.histogram) if count]
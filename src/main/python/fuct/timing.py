@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of fuct. Copyright (c) 2014 Ari Karhu.
+# See the LICENSE file for license rights and limitations (MIT).
+#
+
+__author__ = 'ari'
+
+import os
+import json
+import logging
+
+LOG = logging.getLogger('fuctlog')
+PROFILE_FILE = os.path.join(os.path.expanduser('~'), '.fuct', 'timing.json')
+
+
+def adapter_id(port):
+    """
+    Returns an identifier for the USB-serial adapter behind the port (VID:PID and serial number when available) so
+    the profile follows the adapter even if the device name changes. Falls back to the port name.
+    """
+    try:
+        from serial.tools import list_ports
+        for info in list_ports.comports():
+            # Older pyserial returns plain (port, desc, hwid) tuples
+            if info[0] == port and info[2] and info[2] != 'n/a':
+                return info[2]
+    except ImportError:
+        pass
+    return port
+
+
+def load_profiles(filepath=PROFILE_FILE):
+    if not os.path.isfile(filepath):
+        return {}
+    try:
+        with open(filepath) as f:
+            return json.load(f)
+    except ValueError:
+        LOG.warning("Timing profile file %s is corrupt, ignoring it" % filepath)
+        return {}
+
+
+def load_profile(port, filepath=PROFILE_FILE):
+    return load_profiles(filepath).get(adapter_id(port))
+
+
+def save_profile(port, profile, filepath=PROFILE_FILE):
+    profiles = load_profiles(filepath)
+    key = adapter_id(port)
+    profiles[key] = profile
+    if not os.path.isdir(os.path.dirname(filepath)):
+        os.makedirs(os.path.dirname(filepath))
+    with open(filepath, 'w') as f:
+        f.write(json.dumps(profiles, sort_keys=True, indent=2))
+    return key
+
+
+def fit_line(points):
+    """
+    Least squares fit of (x, y) points, returns (intercept, slope)
+    """
+    n = float(len(points))
+    sx = sum(x for x, _ in points)
+    sy = sum(y for _, y in points)
+    sxx = sum(x * x for x, _ in points)
+    sxy = sum(x * y for x, y in points)
+    slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+    return (sy - slope * sx) / n, slope
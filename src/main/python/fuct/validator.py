@@ -7,35 +7,118 @@
 __author__ = 'ari'
 
 import logging
+import binascii
+from collections import namedtuple
 from srecord import SRecord, STYPES
+import pages
 
 LOG = logging.getLogger('fuctlog')
+BATCH_LINES = 1024
 
+Firmware = namedtuple('Firmware', ['header', 'termination', 'records', 'image'])
 
-def verify_firmware(filepath):
-    content = open(filepath).read()
-    cr_count = content.count('\r')
-    lf_count = content.count('\n')
 
-    if lf_count > 0 and cr_count == 0:
-        LOG.info("S19 file contains " + str(lf_count) + " lines (Unix)")
-    elif lf_count == 0 and cr_count > 0:
-        LOG.info("S19 file contains " + str(lf_count) + " lines (old Macintosh)")
-    elif 0 < cr_count == lf_count:
-        LOG.info("S19 file contains " + str(lf_count) + " lines (Windows)")
-    elif 0 < lf_count != 0 < cr_count:
+def verify_firmware(filepath, image=None):
+    """
+    Streams the S19 file through the batch parser. Data records are fed straight into the flash image when one is
+    given so only the header and the termination record are kept. Returns Firmware or None if the file is invalid.
+    """
+    info = {'header': None, 'termination': None, 'records': 0}
+
+    def data_records(records):
+        for rec in records:
+            info['records'] += 1
+            if rec.stype[0] == 'S0':
+                info['header'] = rec
+            elif rec.stype[0] in ('S7', 'S8', 'S9'):
+                info['termination'] = rec
+            else:
+                yield rec
+
+    with open(filepath, 'rU') as f:
+        try:
+            if image is not None:
+                pages.records_to_image(data_records(iter_records(f)), image)
+            else:
+                for _ in data_records(iter_records(f)):
+                    pass
+        except TypeError, ex:
+            LOG.error(ex.message)
+            return None
+        eol = f.newlines
+
+    lines = info['records']
+    if eol == '\n':
+        LOG.info("S19 file contains " + str(lines) + " lines (Unix)")
+    elif eol == '\r':
+        LOG.info("S19 file contains " + str(lines) + " lines (old Macintosh)")
+    elif eol == '\r\n':
+        LOG.info("S19 file contains " + str(lines) + " lines (Windows)")
+    elif isinstance(eol, tuple):
         LOG.warning("S19 file contains mixed EOL characters?!")
-    elif lf_count == cr_count == 0:
+    else:
         LOG.warning("S19 file contains no EOL chatacters?!")
 
+    if lines == 0:
+        LOG.error("S19 file contains no records")
+        return None
+
+    return Firmware(info['header'], info['termination'], lines, image)
+
+
+def iter_records(lines):
+    """
+    Yields S-records from an iterable of lines. Lines are decoded BATCH_LINES at a time.
+    """
+    batch = []
+    first_line = 0
+    for line in lines:
+        batch.append(line.rstrip('\r\n'))
+        if len(batch) == BATCH_LINES:
+            for rec in parse_batch(batch, first_line):
+                yield rec
+            first_line += len(batch)
+            batch = []
+    if batch:
+        for rec in parse_batch(batch, first_line):
+            yield rec
+
+
+def parse_batch(lines, first_line=0):
+    """
+    Decodes a batch of lines with a single hex decode. If anything in the batch is off the lines are parsed one by
+    one with parse_line to get the exact error for the offending line.
+    """
+    try:
+        text = ''.join(lines)
+        if not (text.isupper() or text.islower()):
+            raise TypeError()
+        buf = bytearray(binascii.unhexlify(''.join([line[2:] for line in lines])))
+
+        records = []
+        offset = 0
+        for line in lines:
+            stype = STYPES.get(line[:2])
+            if stype is None or len(line) < 10 or len(line) % 2 != 0:
+                raise TypeError()
+            size = (len(line) - 2) / 2
+            end = offset + size
+            data_len = size - stype[1] - 2
+            if buf[offset] != size - 1 or sum(buf[offset:end]) & 0xFF != 0xFF or data_len > 256 or \
+                    (stype[2] and data_len == 0) or (not stype[2] and data_len > 0):
+                raise TypeError()
+            records.append(SRecord(stype, int(line[4:4 + stype[1] * 2], 16), buf[end - data_len - 1:end - 1]))
+            offset = end
+        return records
+    except TypeError:
+        pass
+
     records = []
-    for ln, line in enumerate(content.splitlines()):
+    for ln, line in enumerate(lines):
         try:
             records.append(parse_line(line))
         except TypeError, ex:
-            LOG.error("Line %d: %s" % (ln + 1, ex.message))
-            return None
-
+            raise TypeError("Line %d: %s" % (first_line + ln + 1, ex.message))
     return records
 
 
@@ -60,7 +143,7 @@ def parse_record(line):
     stype = STYPES.get(line[:2])
     adata = bytearray(line[2:].decode("hex"))
     bytecount = ord(adata[:1])
-    address = adata[1:stype[1]+1]  # FIXME: Add support for S5 2,3,4 byte address space
+    address = int(line[4:4 + stype[1] * 2], 16)  # FIXME: Add support for S5 2,3,4 byte address space
     data = adata[stype[1]+1:-1]
     checksum = ord(adata[-1:])
 